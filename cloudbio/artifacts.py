@@ -0,0 +1,157 @@
+"""Cache of files installed by custom builds, reused on matching targets.
+
+Builds done through _get_install and _get_install_local are compiled once and
+the files they install are captured into a tarball stored on the machine
+running fabric. Later installs of the same source, on the same distribution
+and architecture with an unchanged build function, unpack the tarball instead
+of building again.
+
+Artifacts are keyed by:
+
+  - source URL and revision
+  - distribution, dist_name and machine architecture of the target
+  - system_install and local_install paths
+  - a fingerprint of the code and closure values of the build functions
+
+Installed files are found as those newer than a stamp created right before the
+build starts, so capture is skipped while builds run concurrently on the same
+target, where files from other builds could be picked up.
+
+Configuration, in fabricrc.txt:
+
+  - artifact_cache_dir -- Directory to keep build artifacts in; disabled if unset.
+  - artifact_cache_max_size -- Maximum size of the cache, like 50G.
+"""
+import functools
+import hashlib
+import os
+import tempfile
+import types
+
+from fabric.api import env, settings, hide
+
+from cloudbio import cache, hostfacts
+
+STAMP_NAME = "cbl_artifact.stamp"
+
+
+def artifact_cache():
+    """Retrieve the configured artifact cache, or None if caching is disabled.
+    """
+    cache_dir = env.get("artifact_cache_dir", None)
+    if not cache_dir:
+        return None
+    return cache.FileCache(cache_dir, env.get("artifact_cache_max_size", None), name="artifact")
+
+
+def _code_fingerprint(code, hasher):
+    hasher.update(code.co_code)
+    hasher.update(repr(code.co_names))
+    for const in code.co_consts:
+        # nested functions have code objects with memory addresses in their repr
+        if isinstance(const, types.CodeType):
+            _code_fingerprint(const, hasher)
+        else:
+            hasher.update(repr(const))
+
+
+def fingerprint(fn, hasher=None, _seen=None):
+    """Hash the code and closure values of a build function.
+    """
+    if hasher is None:
+        hasher = hashlib.sha1()
+    if _seen is None:
+        _seen = set([])
+    if fn is None or id(fn) in _seen:
+        return hasher.hexdigest()
+    _seen.add(id(fn))
+    if isinstance(fn, functools.partial):
+        fingerprint(fn.func, hasher, _seen)
+        hasher.update(repr((fn.args, sorted((fn.keywords or {}).items()))))
+        return hasher.hexdigest()
+    code = getattr(fn, "func_code", None)
+    if code is None:
+        hasher.update(getattr(fn, "__name__", type(fn).__name__))
+        return hasher.hexdigest()
+    _code_fingerprint(code, hasher)
+    for cell in fn.func_closure or []:
+        val = cell.cell_contents
+        if callable(val):
+            fingerprint(val, hasher, _seen)
+        else:
+            hasher.update(repr(val))
+    return hasher.hexdigest()
+
+
+def artifact_key(url, revision, *build_fns):
+    """Cache key for a build, or None if the build should not be cached.
+    """
+    artifacts = artifact_cache()
+    if artifacts is None:
+        return None
+    # Version control checkouts without a fixed revision change over time
+    if url.startswith(("git", "svn", "hg", "cvs")) and not revision:
+        return None
+    return artifacts.key("artifact", url, revision or "", env.get("distribution", ""),
+                         env.get("dist_name", ""), hostfacts.machine(),
+                         env.system_install, env.get("local_install", ""),
+                         *[fingerprint(fn) for fn in build_fns])
+
+
+def restore(key, work_dir):
+    """Unpack a cached build artifact onto the target, returning True on success.
+    """
+    if key is None:
+        return False
+    cached = artifact_cache().get(key)
+    if not cached:
+        return False
+    env.logger.info("Installing prebuilt artifact %s" % os.path.basename(cached))
+    remote_file = os.path.join(work_dir, os.path.basename(cached))
+    env.safe_put(cached, remote_file)
+    env.safe_sudo("tar -C / -xzpf %s" % remote_file)
+    return True
+
+
+def start(key, work_dir):
+    """Mark the start of a build so installed files can be identified afterwards.
+    """
+    if key is None or env.get("concurrent_builds"):
+        return None
+    stamp = os.path.join(work_dir, STAMP_NAME)
+    env.safe_run("touch %s" % stamp)
+    return stamp
+
+
+def capture(key, stamp, work_dir, url, install_dirs):
+    """Store files installed since `stamp` in `install_dirs` as a build artifact.
+    """
+    if key is None or stamp is None:
+        return
+    file_list = os.path.join(work_dir, "cbl_artifact.files")
+    remote_file = os.path.join(work_dir, "%s.tar.gz" % key)
+    dirs = " ".join("'%s'" % d for d in install_dirs)
+    with settings(hide('everything'), warn_only=True):
+        # compare status change times, since installs may preserve original mtimes
+        env.safe_sudo("find %s -xdev -cnewer %s \\( -type f -o -type l \\) 2>/dev/null "
+                      "| sed 's#^/##' > %s" % (dirs, stamp, file_list))
+        count = env.safe_run_output("wc -l < %s" % file_list)
+    try:
+        count = int(count.strip())
+    except ValueError:
+        count = 0
+    if count == 0:
+        env.logger.debug("No installed files found for %s; not caching" % url)
+        return
+    env.safe_sudo("tar -C / -czpf %s -T %s" % (remote_file, file_list))
+    artifacts = artifact_cache()
+    fd, local_file = tempfile.mkstemp(dir=artifacts.cache_dir if os.path.exists(artifacts.cache_dir)
+                                      else None)
+    os.close(fd)
+    try:
+        env.safe_get(remote_file, local_file)
+        artifacts.add(key, local_file, os.path.basename(remote_file), url)
+        env.logger.info("Cached build artifact for %s with %s files" % (url, count))
+    finally:
+        if os.path.exists(local_file):
+            os.remove(local_file)
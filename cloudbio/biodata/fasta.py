@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""Normalize a reference genome FASTA file, writing its indexes in the same pass.
+
+Rewrites a FASTA file with contigs in natural karyotypic order (chr1, chr2,
+..., chr10, ..., chrX, chrY, chrM, then other contigs) and a fixed line width.
+While writing, it produces:
+
+  - a samtools style .fai index
+  - a Picard style .dict sequence dictionary with MD5 checksums of each contig
+  - a .md5 checksum of the output file, in md5sum format
+  - optionally, a UCSC 2bit file (see twobit.py)
+
+The input is read a single time and may be standard input. Contigs already in
+natural order are written directly; otherwise the normalized contigs are
+copied into order as blocks, without parsing them again.
+
+This module has no dependencies outside the standard library and runs under
+Python 2 and 3, so it can be copied to and run on install targets, along with
+twobit.py for 2bit output:
+
+    python fasta.py [--width 60] [--keep-order] [--twobit out.2bit] in.fa [out.fa]
+"""
+import hashlib
+import optparse
+import os
+import re
+import shutil
+import sys
+
+try:
+    from cloudbio.biodata import twobit
+except ImportError:
+    try:
+        import twobit
+    except ImportError:
+        twobit = None
+
+DEFAULT_WIDTH = 60
+COPY_SIZE = 16 * 1024 * 1024
+SPECIAL_CONTIGS = {"X": 1, "Y": 2, "M": 3, "MT": 3}
+
+
+def natural_key(name):
+    """Sort key placing numbered chromosomes, then X, Y and mitochondria first.
+    """
+    base = name[3:] if name.lower().startswith("chr") else name
+    if base.isdigit():
+        return (0, int(base), "")
+    if base.upper() in SPECIAL_CONTIGS:
+        return (SPECIAL_CONTIGS[base.upper()], 0, "")
+    return (4, 0, [int(x) if x.isdigit() else x for x in re.split(r"(\d+)", name)])
+
+
+class _Contig:
+    def __init__(self, name, header):
+        self.name = name
+        self.header = header
+        self.length = 0
+        self.md5 = hashlib.md5()
+        self.start = None
+        self.seq_start = None
+        self.end = None
+
+
+class _SequenceWriter:
+    """Write sequence in fixed width lines, tracking contig lengths and checksums.
+    """
+    def __init__(self, out_handle, width, twobit_writer=None):
+        self.out_handle = out_handle
+        self.width = width
+        self.twobit_writer = twobit_writer
+        self.pending = []
+        self.pending_size = 0
+        self.contig = None
+        self.file_md5 = hashlib.md5()
+
+    def _write(self, data):
+        self.file_md5.update(data)
+        self.out_handle.write(data)
+
+    def start(self, contig):
+        self.finish()
+        self.contig = contig
+        contig.start = self.out_handle.tell()
+        self._write(contig.header + b"\n")
+        contig.seq_start = self.out_handle.tell()
+        if self.twobit_writer:
+            self.twobit_writer.start(contig.name)
+
+    def add(self, seq):
+        if self.twobit_writer:
+            self.twobit_writer.add(seq)
+        self.contig.length += len(seq)
+        self.contig.md5.update(seq.upper())
+        self.pending.append(seq)
+        self.pending_size += len(seq)
+        if self.pending_size >= COPY_SIZE:
+            self._flush(False)
+
+    def _flush(self, final):
+        """Write pending sequence as full lines, including any partial last line if final.
+        """
+        pending = b"".join(self.pending)
+        size = len(pending) if final else len(pending) - len(pending) % self.width
+        block, rest = pending[:size], pending[size:]
+        self.pending = [rest] if rest else []
+        self.pending_size = len(rest)
+        if block:
+            self._write(b"\n".join(block[i:i + self.width]
+                                    for i in range(0, len(block), self.width)) + b"\n")
+
+    def finish(self):
+        if self.contig is not None:
+            self._flush(True)
+            self.contig.end = self.out_handle.tell()
+            self.contig = None
+
+
+def _read_contigs(in_handle, writer):
+    contigs = []
+    names = set([])
+    for line in in_handle:
+        line = line.rstrip()
+        if line.startswith(b">"):
+            header = line
+            name = header[1:].split()[0].decode("ascii") if header[1:].strip() else ""
+            if not name or name in names:
+                raise ValueError("Missing or duplicate contig name in header: %r" % header)
+            names.add(name)
+            contigs.append(_Contig(name, header))
+            writer.start(contigs[-1])
+        elif line:
+            if writer.contig is None:
+                raise ValueError("Sequence found before the first FASTA header")
+            writer.add(line)
+    writer.finish()
+    return contigs
+
+
+def _copy_range(in_handle, out_handle, start, end, md5):
+    in_handle.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = in_handle.read(min(COPY_SIZE, remaining))
+        if not block:
+            raise IOError("Unexpected end of file copying contigs")
+        md5.update(block)
+        out_handle.write(block)
+        remaining -= len(block)
+
+
+def _write_indexes(out_file, contigs, width, file_md5):
+    with open("%s.fai" % out_file, "w") as out_handle:
+        for c in contigs:
+            out_handle.write("%s\t%s\t%s\t%s\t%s\n" % (c.name, c.length, c.seq_start,
+                                                       width, width + 1))
+    dict_file = "%s.dict" % os.path.splitext(out_file)[0]
+    with open(dict_file, "w") as out_handle:
+        out_handle.write("@HD\tVN:1.0\tSO:unsorted\n")
+        for c in contigs:
+            out_handle.write("@SQ\tSN:%s\tLN:%s\tM5:%s\tUR:file:%s\n"
+                             % (c.name, c.length, c.md5.hexdigest(), os.path.abspath(out_file)))
+    with open("%s.md5" % out_file, "w") as out_handle:
+        out_handle.write("%s  %s\n" % (file_md5.hexdigest(), os.path.basename(out_file)))
+
+
+def normalize(in_file, out_file=None, width=DEFAULT_WIDTH, sort=True, twobit_file=None):
+    """Normalize a FASTA file, writing .fai, .dict and .md5 files next to the output.
+
+    `in_file` may be `-` for standard input; `out_file` defaults to replacing
+    `in_file`. Returns a list of (name, length) for the written contigs.
+    """
+    out_file = out_file or in_file
+    if out_file == "-":
+        raise ValueError("An output file is required when reading from standard input")
+    if twobit_file and twobit is None:
+        raise ImportError("twobit.py is required for 2bit output")
+    twobit_writer = twobit.TwoBitWriter(twobit_file) if twobit_file else None
+    tmp_file = "%s.tmp%s" % (out_file, os.getpid())
+    in_handle = getattr(sys.stdin, "buffer", sys.stdin) if in_file == "-" else open(in_file, "rb")
+    try:
+        with open(tmp_file, "wb+") as tmp_handle:
+            writer = _SequenceWriter(tmp_handle, width, twobit_writer)
+            contigs = _read_contigs(in_handle, writer)
+            ordered = sorted(contigs, key=lambda c: natural_key(c.name)) if sort else contigs
+            if [c.name for c in ordered] == [c.name for c in contigs]:
+                final_file = tmp_file
+                file_md5 = writer.file_md5
+            else:
+                final_file = "%s.order%s" % (out_file, os.getpid())
+                file_md5 = hashlib.md5()
+                with open(final_file, "wb") as out_handle:
+                    for c in ordered:
+                        offset = out_handle.tell() - c.start
+                        _copy_range(tmp_handle, out_handle, c.start, c.end, file_md5)
+                        c.start += offset
+                        c.seq_start += offset
+                        c.end += offset
+        if final_file != tmp_file:
+            os.remove(tmp_file)
+        shutil.move(final_file, out_file)
+    finally:
+        if in_file != "-":
+            in_handle.close()
+        for fname in [tmp_file, "%s.order%s" % (out_file, os.getpid())]:
+            if os.path.exists(fname):
+                os.remove(fname)
+    _write_indexes(out_file, ordered, width, file_md5)
+    if twobit_writer:
+        twobit_writer.close([c.name for c in ordered])
+    return [(c.name, c.length) for c in ordered]
+
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options] in.fa [out.fa]")
+    parser.add_option("-w", "--width", dest="width", type="int", default=DEFAULT_WIDTH)
+    parser.add_option("-t", "--twobit", dest="twobit_file", help="Also write a UCSC 2bit file")
+    parser.add_option("-k", "--keep-order", dest="sort", action="store_false", default=True,
+                      help="Keep contigs in input order")
+    (options, args) = parser.parse_args(args)
+    if len(args) not in [1, 2]:
+        parser.error("Specify an input FASTA file and optional output file")
+    contigs = normalize(args[0], args[1] if len(args) > 1 else None, options.width, options.sort,
+                        options.twobit_file)
+    sys.stderr.write("Wrote %s contigs, %s bases\n" % (len(contigs), sum(l for _, l in contigs)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
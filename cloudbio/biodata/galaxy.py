@@ -7,6 +7,8 @@ from xml.etree import ElementTree
 from fabric.api import *
 from fabric.contrib.files import *
 
+from cloudbio.custom import shared
+
 # ## Compatibility definitions
 
 server = "rsync://datacache.g2.bx.psu.edu"
@@ -137,8 +139,14 @@ def _finalize_index_seq(fname):
     """
     out_fasta = fname + ".fa"
     if not env.safe_exists(out_fasta):
-        env.safe_run("twoBitToFa {base}.2bit {out}".format(
-            base=fname, out=out_fasta))
+        if shared._executable_not_on_path("twoBitToFa"):
+            from cloudbio.biodata.genomes import _biodata_scripts
+            with _biodata_scripts() as script:
+                env.safe_run("{script} --to-fasta {base}.2bit {out}".format(
+                    script=script("twobit"), base=fname, out=out_fasta))
+        else:
+            env.safe_run("twoBitToFa {base}.2bit {out}".format(
+                base=fname, out=out_fasta))
 
 finalize_fns = {"ucsc": _finalize_index_seq,
                 "seq": index_picard}
@@ -12,7 +12,6 @@ The main targets are fabric functions:
 
 """
 import os
-import operator
 import socket
 import subprocess
 from contextlib import contextmanager
@@ -29,7 +28,8 @@ try:
 except ImportError:
     boto = None
 
-from cloudbio.biodata import galaxy
+from cloudbio import hostfacts, scheduler
+from cloudbio.biodata import fasta, galaxy, twobit
 from cloudbio.biodata.dbsnp import download_dbsnp
 from cloudbio.biodata.rnaseq import download_transcripts
 from cloudbio.custom import shared
@@ -46,7 +46,8 @@ class _DownloadHelper:
     def _exists(self, fname, seq_dir):
         """Check if a file exists in either download or final destination.
         """
-        return env.safe_exists(fname) or env.safe_exists(os.path.join(seq_dir, fname))
+        return any(env.safe_probe([("exists", fname),
+                                   ("exists", os.path.join(seq_dir, fname))]))
 
 class UCSCGenome(_DownloadHelper):
     def __init__(self, genome_name, dl_name=None):
@@ -64,45 +65,53 @@ class UCSCGenome(_DownloadHelper):
         zipped_file = None
         genome_file = "%s.fa" % self._name
         if not self._exists(genome_file, seq_dir):
-            zipped_file = self._download_zip(seq_dir)
-            if zipped_file.endswith(".tar.gz"):
-                env.safe_run("tar -xzpf %s" % zipped_file)
-            elif zipped_file.endswith(".zip"):
-                env.safe_run("unzip %s" % zipped_file)
-            elif zipped_file.endswith(".gz"):
-                env.safe_run("gunzip -c %s > out.fa" % zipped_file)
-            else:
-                raise ValueError("Do not know how to handle: %s" % zipped_file)
-            tmp_file = genome_file.replace(".fa", ".txt")
-            with settings(warn_only=True):
-                result = env.safe_run("ls *.fa")
-            # some UCSC downloads have the files in multiple directories
-            # mv them to the parent directory and delete the child directories
-            #ignore_random = " -a \! -name '*_random.fa' -a \! -name 'chrUn*'" \
-            #        "-a \! -name '*hap*.fa'"
-            ignore_random = ""
-            if result.failed:
-                env.safe_run("find . -name '*.fa'%s -exec mv {} . \;" % ignore_random)
-                env.safe_run("find . -type d -a \! -name '\.' | xargs rm -rf")
-            result = env.safe_run("find . -name '*.fa'%s" % ignore_random)
-            result = [x.strip() for x in result.split("\n")]
-            result.sort()
-            env.safe_run("cat %s > %s" % (" ".join(result), tmp_file))
-            env.safe_run("rm -f *.fa")
-            env.safe_run("mv %s %s" % (tmp_file, genome_file))
+            zipped_file = self._stream_fasta(genome_file, seq_dir)
         return genome_file, [zipped_file]
 
-    def _download_zip(self, seq_dir):
+    def _stream_fasta(self, genome_file, seq_dir):
+        """Write the genome as a single FASTA file as it downloads.
+
+        Chromosomes from tarballs are concatenated in archive order without
+        extracting individual files. Returns the name of any downloaded file
+        left on disk.
+        """
+        tmp_file = genome_file.replace(".fa", ".txt")
         for zipped_file in ["chromFa.tar.gz", "%s.fa.gz" % self._name,
                             "chromFa.zip"]:
-            if not self._exists(zipped_file, seq_dir):
-                with settings(warn_only=True):
-                    result = env.safe_run("wget -c %s/%s" % (self._url, zipped_file))
-                if not result.failed:
-                    break
+            local_file = self._local_file(zipped_file, seq_dir)
+            if zipped_file.endswith(".zip"):
+                # zip archives can not be read as a stream
+                if not local_file:
+                    with settings(warn_only=True):
+                        result = env.safe_run("wget -c %s/%s" % (self._url, zipped_file))
+                    if result.failed:
+                        continue
+                    local_file = zipped_file
+                cmd = "unzip -p %s '*.fa'" % local_file
+            elif zipped_file.endswith(".tar.gz"):
+                cmd = "tar -xzOf %s --wildcards '*.fa'" % (local_file or "-")
             else:
-                break
-        return zipped_file
+                cmd = "gunzip -c %s" % (local_file or "")
+            if not local_file:
+                cmd = "wget -O - %s/%s | %s" % (self._url, zipped_file, cmd)
+            with settings(warn_only=True):
+                # run in bash explicitly; /bin/sh may be dash, which lacks pipefail
+                result = env.safe_run("bash -o pipefail -c \"%s > %s\"" % (cmd, tmp_file))
+            if result.failed:
+                env.safe_run("rm -f %s" % tmp_file)
+                continue
+            env.safe_run("mv %s %s" % (tmp_file, genome_file))
+            return os.path.basename(local_file) if local_file else None
+        raise IOError("Could not download %s genome from %s" % (self._name, self._url))
+
+    def _local_file(self, fname, seq_dir):
+        """Retrieve a previously downloaded file in the download or final directory.
+        """
+        choices = [fname, os.path.join(seq_dir, fname)]
+        for choice, found in zip(choices, env.safe_probe([("exists", x) for x in choices])):
+            if found:
+                return choice
+        return None
 
 class NCBIRest(_DownloadHelper):
     """Retrieve files using the TogoWS REST server pointed at NCBI.
@@ -228,6 +237,7 @@ GENOMES_SUPPORTED = [
 GENOME_INDEXES_SUPPORTED = ["bowtie", "bowtie2", "bwa", "maq", "novoalign", "novoalign-cs",
                             "ucsc", "mosaik"]
 DEFAULT_GENOME_INDEXES = ["ucsc", "seq"]
+DEFAULT_GENOME_SIZE_GB = 3.1
 
 # -- Fabric instructions
 
@@ -346,36 +356,126 @@ def _make_genome_dir():
         env.safe_sudo("chown -R %s %s" % (env.user, genome_dir))
     return genome_dir
 
+def _present_indexes(org_dir, genome_indexes):
+    """Check for an organism directory and its prepared indexes in one remote call.
+
+    Creates the organism directory if missing, returning a dictionary of
+    index names to existence.
+    """
+    checks = [("exists", org_dir)] + [("exists", os.path.join(org_dir, idx))
+                                      for idx in genome_indexes]
+    present = env.safe_probe(checks)
+    if not present[0]:
+        env.safe_run('mkdir -p %s' % org_dir)
+    return dict(zip(genome_indexes, present[1:]))
+
+def _find_ref_file(org_dir, gid, manager):
+    """Retrieve the reference FASTA file, named by either genome id or download name.
+    """
+    choices = [os.path.join(org_dir, "seq", "%s.fa" % gid),
+               os.path.join(org_dir, "seq", "%s.fa" % manager._name)]
+    for ref_file, found in zip(choices, env.safe_probe([("exists", x) for x in choices])):
+        if found:
+            return ref_file
+    raise AssertionError(choices[-1])
+
 def _prep_genomes(env, genomes, genome_indexes, retrieve_fns):
     """Prepare genomes with the given indexes, supporting multiple retrieval methods.
     """
     genome_dir = _make_genome_dir()
+    workers = _genome_index_workers()
+    if workers > 1:
+        return _parallel_prep_genomes(genome_dir, genomes, genome_indexes, retrieve_fns, workers)
     for (orgname, gid, manager) in genomes:
         org_dir = os.path.join(genome_dir, orgname, gid)
-        if not env.safe_exists(org_dir):
-            env.safe_run('mkdir -p %s' % org_dir)
+        present = _present_indexes(org_dir, genome_indexes)
         for idx in genome_indexes:
-            with cd(org_dir):
-                if not env.safe_exists(idx):
-                    finished = False
-                    for method, retrieve_fn in retrieve_fns:
-                        try:
-                            retrieve_fn(env, manager, gid, idx)
-                            finished = True
-                            break
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            env.logger.exception("Genome preparation method {0} failed, trying next".format(method))
-                    if not finished:
-                        raise IOError("Could not prepare index {0} for {1} by any method".format(idx, gid))
-        ref_file = os.path.join(org_dir, "seq", "%s.fa" % gid)
-        if not env.safe_exists(ref_file):
-            ref_file = os.path.join(org_dir, "seq", "%s.fa" % manager._name)
-        assert env.safe_exists(ref_file), ref_file
+            if not present[idx]:
+                _prep_index(org_dir, manager, gid, idx, retrieve_fns)
+        ref_file = _find_ref_file(org_dir, gid, manager)
         cur_indexes = manager.config.get("indexes", genome_indexes)
         _index_to_galaxy(org_dir, ref_file, gid, cur_indexes, manager.config)
 
+def _prep_index(org_dir, manager, gid, idx, retrieve_fns):
+    """Prepare a single index, trying each retrieval method in turn.
+    """
+    with cd(org_dir):
+        for method, retrieve_fn in retrieve_fns:
+            try:
+                retrieve_fn(env, manager, gid, idx)
+                return
+            except KeyboardInterrupt:
+                raise
+            except:
+                env.logger.exception("Genome preparation method {0} failed, trying next".format(method))
+    raise IOError("Could not prepare index {0} for {1} by any method".format(idx, gid))
+
+def _genome_index_workers():
+    """Number of genome index builds to run at once, from `genome_index_workers`.
+    """
+    setting = str(env.get("genome_index_workers", "1"))
+    if setting.lower() == "auto":
+        return scheduler.available_workers(hostfacts.cores(), hostfacts.memory_gb())
+    return max(int(setting), 1)
+
+def _ref_size_gb(org_dir, gid):
+    """Size of an already downloaded reference genome, defaulting to a human sized genome.
+    """
+    with settings(hide('everything'), warn_only=True):
+        out = env.safe_run_output("du -k %s" % os.path.join(org_dir, "seq", "%s.fa" % gid))
+    try:
+        return int(out.split()[0]) / float(1024 * 1024)
+    except (ValueError, IndexError):
+        return DEFAULT_GENOME_SIZE_GB
+
+def _parallel_prep_genomes(genome_dir, genomes, genome_indexes, retrieve_fns, workers):
+    """Prepare indexes for all genomes concurrently.
+
+    Each genome's indexes wait on its `seq` preparation, which retrieves the
+    reference sequence. Jobs are limited by estimated memory use so several
+    large index builds do not run out of memory together. Galaxy location
+    files are updated serially once a genome's indexes are ready.
+    """
+    log_dir = os.path.join(env.get("custom_install_log_dir", "cbl_logs"),
+                           env.host_string or "localhost", "genomes")
+    base_work_dir = shared._work_dir()
+    def _index_job(org_dir, manager, gid, idx):
+        def _run():
+            # separate temporary directories, removed independently by each job
+            env.work_dir = os.path.join(base_work_dir, "%s-%s" % (gid, idx))
+            _prep_index(org_dir, manager, gid, idx, retrieve_fns)
+        return _run
+    jobs = []
+    genome_jobs = {}
+    for (orgname, gid, manager) in genomes:
+        org_dir = os.path.join(genome_dir, orgname, gid)
+        present = _present_indexes(org_dir, genome_indexes)
+        size_gb = _ref_size_gb(org_dir, gid)
+        genome_jobs[gid] = []
+        for idx in genome_indexes:
+            if not present[idx]:
+                name = "%s:%s" % (gid, idx)
+                depends = ["%s:seq" % gid] if idx != "seq" else []
+                jobs.append(scheduler.Job(name, _index_job(org_dir, manager, gid, idx), depends,
+                                          INDEX_MEMORY.get(idx, 1.0) * size_gb))
+                genome_jobs[gid].append(name)
+    env.logger.info("Preparing %s genome indexes with %s workers; logs in %s"
+                    % (len(jobs), workers, log_dir))
+    results = scheduler.run_jobs(jobs, workers, hostfacts.memory_gb(), log_dir)
+    problems = []
+    for (orgname, gid, manager) in genomes:
+        failed = [n for n in genome_jobs[gid] if results[n].status != "ok"]
+        if failed:
+            problems.extend("%s (%s)" % (n, results[n].status) for n in failed)
+            continue
+        org_dir = os.path.join(genome_dir, orgname, gid)
+        ref_file = _find_ref_file(org_dir, gid, manager)
+        cur_indexes = manager.config.get("indexes", genome_indexes)
+        _index_to_galaxy(org_dir, ref_file, gid, cur_indexes, manager.config)
+    if problems:
+        raise IOError("Could not prepare genome indexes: %s. See logs in %s"
+                      % (", ".join(sorted(problems)), log_dir))
+
 # ## Genomes index for next-gen sequencing tools
 
 def _get_ref_seq(env, manager):
@@ -384,6 +484,8 @@ def _get_ref_seq(env, manager):
     seq_dir = os.path.join(env.cwd, "seq")
     ref_file, base_zips = manager.download(seq_dir)
     ref_file = _move_seq_files(ref_file, base_zips, seq_dir)
+    # normalize contig order before building any indexes from the sequence
+    _index_sam(ref_file)
     return ref_file
 
 def _prep_raw_index(env, manager, gid, idx):
@@ -410,6 +512,7 @@ def _data_ngs_genomes(genomes, genome_indexes):
             seq_dir = 'seq'
             ref_file, base_zips = manager.download(seq_dir)
             ref_file = _move_seq_files(ref_file, base_zips, seq_dir)
+            _index_sam(ref_file)
         cur_indexes = manager.config.get("indexes", genome_indexes)
         _index_to_galaxy(cur_dir, ref_file, genome, cur_indexes, manager.config)
 
@@ -469,15 +572,17 @@ def _prep_custom_genome(custom, genomes, genome_indexes, env):
 def _clean_genome_directory():
     """Remove any existing sequence information in the current directory.
     """
-    for dirname in GENOME_INDEXES_SUPPORTED + DEFAULT_GENOME_INDEXES:
-        if env.safe_exists(dirname):
+    dirnames = GENOME_INDEXES_SUPPORTED + DEFAULT_GENOME_INDEXES
+    for dirname, found in zip(dirnames, env.safe_probe([("exists", d) for d in dirnames])):
+        if found:
             env.safe_run("rm -rf %s" % dirname)
 
 def _move_seq_files(ref_file, base_zips, seq_dir):
     if not env.safe_exists(seq_dir):
         env.safe_run('mkdir %s' % seq_dir)
-    for move_file in [ref_file] + base_zips:
-        if env.safe_exists(move_file):
+    to_move = [ref_file] + base_zips
+    for move_file, found in zip(to_move, env.safe_probe([("exists", x) for x in to_move])):
+        if found:
             env.safe_run("mv %s %s" % (move_file, seq_dir))
     path, fname = os.path.split(ref_file)
     moved_ref = os.path.join(path, seq_dir, fname)
@@ -502,13 +607,17 @@ def _index_w_command(dir_name, command, ref_file, pre=None, post=None, ext=None)
                 post(full_ref_path)
     return os.path.join(dir_name, index_name)
 
-@_if_installed("faToTwoBit")
 def _index_twobit(ref_file):
     """Index reference files using 2bit for random access.
+
+    Uses faToTwoBit when installed, otherwise the included 2bit writer.
     """
     dir_name = "ucsc"
     cmd = "faToTwoBit {ref_file} {index_name}"
-    return _index_w_command(dir_name, cmd, ref_file)
+    if env.safe_exists(dir_name) or not shared._executable_not_on_path("faToTwoBit"):
+        return _index_w_command(dir_name, cmd, ref_file)
+    with _biodata_scripts() as script:
+        return _index_w_command(dir_name, script("twobit") + " {ref_file} {index_name}", ref_file)
 
 def _index_bowtie(ref_file):
     dir_name = "bowtie"
@@ -562,10 +671,50 @@ def _index_sam(ref_file):
     (ref_dir, local_file) = os.path.split(ref_file)
     with cd(ref_dir):
         if not env.safe_exists("%s.fai" % local_file):
-            env.safe_run("samtools faidx %s" % local_file)
+            _normalize_fasta(local_file)
     galaxy.index_picard(ref_file)
     return ref_file
 
+@contextmanager
+def _biodata_scripts():
+    """Copy the standalone FASTA and 2bit scripts to the target.
+
+    Yields a function returning the command line to run a script by name.
+    """
+    with shared._make_tmp_dir() as work_dir:
+        script_dir = os.path.join(work_dir, "cbl_biodata_%s" % os.getpid())
+        env.safe_run("mkdir -p %s" % script_dir)
+        for module in [fasta, twobit]:
+            script = os.path.splitext(os.path.basename(module.__file__))[0] + ".py"
+            env.safe_put(os.path.join(os.path.dirname(module.__file__), script),
+                         os.path.join(script_dir, script))
+        try:
+            yield lambda name: "%s %s" % (shared._python_cmd(env),
+                                          os.path.join(script_dir, "%s.py" % name))
+        finally:
+            env.safe_run("rm -rf %s" % script_dir)
+
+def _normalize_fasta(local_file):
+    """Reorder and rewrap a reference FASTA, writing .fai, .dict and .md5 files in one pass.
+
+    The ucsc 2bit index is written in the same pass if not already present.
+    Falls back to samtools indexing if the normalization script fails.
+    """
+    twobit_dir = os.path.join(os.pardir, "ucsc")
+    make_twobit = not env.safe_exists(twobit_dir)
+    cmd = "{fasta} %s" % local_file
+    if make_twobit:
+        env.safe_run("mkdir -p %s" % twobit_dir)
+        cmd += " --twobit %s" % os.path.join(twobit_dir, os.path.splitext(local_file)[0])
+    with _biodata_scripts() as script:
+        with settings(warn_only=True):
+            result = env.safe_run(cmd.format(fasta=script("fasta")))
+    if result.failed:
+        env.logger.warn("Could not normalize %s; indexing with samtools" % local_file)
+        if make_twobit:
+            env.safe_run("rm -rf %s" % twobit_dir)
+        env.safe_run("samtools faidx %s" % local_file)
+
 @_if_installed("MosaikJump")
 def _index_mosaik(ref_file):
     hash_size = 15
@@ -596,16 +745,12 @@ def _download_genomes(genomes, genome_indexes):
     genome_dir = _make_genome_dir()
     for (orgname, gid, manager) in genomes:
         org_dir = os.path.join(genome_dir, orgname, gid)
-        if not env.safe_exists(org_dir):
-            env.safe_run('mkdir -p %s' % org_dir)
+        present = _present_indexes(org_dir, genome_indexes)
         for idx in genome_indexes:
             with cd(org_dir):
-                if not env.safe_exists(idx):
+                if not present[idx]:
                     _download_s3_index(env, manager, gid, idx)
-        ref_file = os.path.join(org_dir, "seq", "%s.fa" % gid)
-        if not env.safe_exists(ref_file):
-            ref_file = os.path.join(org_dir, "seq", "%s.fa" % manager._name)
-        assert env.safe_exists(ref_file), ref_file
+        ref_file = _find_ref_file(org_dir, gid, manager)
         cur_indexes = manager.config.get("indexes", genome_indexes)
         _index_to_galaxy(org_dir, ref_file, gid, cur_indexes, manager.config)
 
@@ -653,8 +798,9 @@ def _clean_directory(dir, gid):
     # get rid of softlinks
     bowtie_ln = os.path.join(dir, "bowtie", "%s.fa" % gid)
     maq_ln = os.path.join(dir, "maq", "%s.fa" % gid)
-    for to_remove in [bowtie_ln, maq_ln]:
-        if env.safe_exists(to_remove):
+    links = [bowtie_ln, maq_ln]
+    for to_remove, found in zip(links, env.safe_probe([("exists", x) for x in links])):
+        if found:
             env.safe_run("rm -f %s" % to_remove)
     # remove any downloaded original sequence files
     remove_exts = ["*.gz", "*.zip"]
@@ -729,8 +875,8 @@ def _index_blast_db(work_dir, base_file, db_type):
     type_to_ext = dict(prot = ("phr", "pal"), nucl = ("nhr", "nal"))
     db_name = os.path.splitext(base_file)[0]
     with cd(work_dir):
-        if not reduce(operator.or_,
-            (env.safe_exists("%s.%s" % (db_name, ext)) for ext in type_to_ext[db_type])):
+        if not any(env.safe_probe([("exists", "%s.%s" % (db_name, ext))
+                                   for ext in type_to_ext[db_type]])):
             env.safe_run("makeblastdb -in %s -dbtype %s -out %s" %
                          (base_file, db_type, db_name))
 
@@ -746,3 +892,16 @@ INDEX_FNS = {
     "novoalign_cs": _index_novoalign_cs,
     "ucsc": _index_twobit,
     }
+
+# Estimated peak memory of each index build, in Gb per Gb of genome sequence
+INDEX_MEMORY = {
+    "seq": 0.5,
+    "bwa": 1.8,
+    "bowtie": 1.3,
+    "bowtie2": 1.3,
+    "maq": 1.0,
+    "mosaik": 6.0,
+    "novoalign": 2.6,
+    "novoalign-cs": 2.6,
+    "ucsc": 0.5,
+    }
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""Write and read UCSC 2bit files without the UCSC command line tools.
+
+The writer packs nucleotides four to a byte, recording runs of N (any base
+other than A, C, G or T) and of lower case soft-masked bases as blocks, like
+faToTwoBit. Sequence is fed in pieces as it is read, so a FASTA file can be
+converted while it is normalized (see fasta.py) without holding more than one
+packed contig in memory.
+
+Packing and unpacking are vectorized with NumPy when it is available, with a
+pure Python fallback. The reader memory maps the file to retrieve sequence
+names, lengths and regions.
+
+This module has no required dependencies outside the standard library and
+runs under Python 2 and 3, so it can be copied to and run on install targets:
+
+    python twobit.py in.fa out.2bit
+    python twobit.py --to-fasta in.2bit out.fa
+"""
+import array
+import binascii
+import mmap
+import optparse
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIGNATURE = 0x1A412743
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_FILE_SIZE = 2 ** 32 - 1
+BASES = b"TCAG"
+
+_N_RE = re.compile(b"[^ACGTacgt]+")
+_MASK_RE = re.compile(b"[a-z]+")
+
+
+def _array_bytes(arr):
+    return arr.tobytes() if hasattr(arr, "tobytes") else arr.tostring()
+
+
+def _uint32_array():
+    for code in ["I", "L"]:
+        if array.array(code).itemsize == 4:
+            return array.array(code)
+    raise ValueError("No 32 bit unsigned array type available")
+
+
+def _digit_table():
+    """Translation of bases into base 4 digits, with N and others stored as T.
+    """
+    table = bytearray(b"0" * 256)
+    for i, base in enumerate(bytearray(BASES)):
+        table[base] = table[base + 32] = ord("0") + i
+    return bytes(table)
+
+
+_DIGITS = _digit_table()
+
+
+def _pack_python(seq):
+    """Pack bases four to a byte with base 4 integer conversion; len(seq) % 4 == 0.
+    """
+    if not seq:
+        return b""
+    digits = seq.translate(_DIGITS)
+    return binascii.unhexlify("%0*x" % (len(seq) // 2, int(digits, 4)))
+
+
+def _pack_numpy(seq):
+    codes = _NUMPY_CODES[numpy.frombuffer(seq, dtype=numpy.uint8)].reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+    return packed.astype(numpy.uint8).tobytes()
+
+if numpy is not None:
+    _NUMPY_CODES = numpy.zeros(256, dtype=numpy.uint8)
+    for _i, _base in enumerate(bytearray(BASES)):
+        _NUMPY_CODES[_base] = _NUMPY_CODES[_base + 32] = _i
+    _pack = _pack_numpy
+else:
+    _pack = _pack_python
+
+
+def _runs_numpy(seq, flags):
+    """Starts and ends of runs where `flags` is set, from a boolean array.
+    """
+    edges = numpy.diff(numpy.concatenate(([0], flags.view(numpy.int8), [0])))
+    return zip(numpy.flatnonzero(edges == 1).tolist(), numpy.flatnonzero(edges == -1).tolist())
+
+
+def _find_runs(seq):
+    """Retrieve (N runs, lower case runs) in a piece of sequence as (start, end) pairs.
+    """
+    if numpy is not None:
+        arr = numpy.frombuffer(seq, dtype=numpy.uint8)
+        upper = arr & 0xDF
+        is_n = ~((upper == 65) | (upper == 67) | (upper == 71) | (upper == 84))
+        is_lower = (arr >= 97) & (arr <= 122)
+        return _runs_numpy(seq, is_n), _runs_numpy(seq, is_lower)
+    return ([m.span() for m in _N_RE.finditer(seq)],
+            [m.span() for m in _MASK_RE.finditer(seq)])
+
+
+class _Blocks:
+    """Runs of positions stored compactly, merging runs which continue across pieces.
+    """
+    def __init__(self):
+        self.starts = _uint32_array()
+        self.sizes = _uint32_array()
+        self._end = None
+
+    def add(self, offset, runs):
+        for start, end in runs:
+            start += offset
+            end += offset
+            if self._end == start:
+                self.sizes[-1] += end - start
+            else:
+                self.starts.append(start)
+                self.sizes.append(end - start)
+            self._end = end
+
+    def to_bytes(self):
+        starts, sizes = self.starts, self.sizes
+        if sys.byteorder != "little":
+            starts, sizes = array.array(starts.typecode, starts), array.array(sizes.typecode, sizes)
+            starts.byteswap()
+            sizes.byteswap()
+        return struct.pack("<I", len(starts)) + _array_bytes(starts) + _array_bytes(sizes)
+
+
+class TwoBitWriter:
+    """Write sequences to a 2bit file, added in pieces.
+
+    Call start() for each sequence, add() with its bases, then close() to
+    write the file with sequences listed in the given order.
+    """
+    def __init__(self, out_file):
+        self.out_file = out_file
+        out_dir = os.path.dirname(os.path.abspath(out_file))
+        self._records = tempfile.TemporaryFile(dir=out_dir)
+        self._offsets = {}
+        self._names = []
+        self._name = None
+
+    def start(self, name):
+        self.finish()
+        if name in self._offsets:
+            raise ValueError("Duplicate sequence name: %s" % name)
+        self._name = name
+        self._size = 0
+        self._pending = []
+        self._pending_size = 0
+        self._packed = []
+        self._n_blocks = _Blocks()
+        self._mask_blocks = _Blocks()
+
+    def add(self, seq):
+        self._pending.append(seq)
+        self._pending_size += len(seq)
+        if self._pending_size >= CHUNK_SIZE:
+            self._process(False)
+
+    def _process(self, final):
+        seq = b"".join(self._pending)
+        size = len(seq) if final else len(seq) - len(seq) % 4
+        piece, rest = seq[:size], seq[size:]
+        self._pending = [rest] if rest else []
+        self._pending_size = len(rest)
+        n_runs, mask_runs = _find_runs(piece)
+        self._n_blocks.add(self._size, n_runs)
+        self._mask_blocks.add(self._size, mask_runs)
+        self._size += len(piece)
+        if len(piece) % 4:
+            piece += b"T" * (4 - len(piece) % 4)
+        self._packed.append(_pack(piece))
+
+    def finish(self):
+        """Write the record for the current sequence.
+        """
+        if self._name is None:
+            return
+        self._process(True)
+        self._offsets[self._name] = self._records.tell()
+        self._names.append(self._name)
+        self._records.write(struct.pack("<I", self._size))
+        self._records.write(self._n_blocks.to_bytes())
+        self._records.write(self._mask_blocks.to_bytes())
+        self._records.write(struct.pack("<I", 0))
+        for packed in self._packed:
+            self._records.write(packed)
+        self._name = None
+        self._packed = []
+
+    def close(self, order=None):
+        """Write the 2bit file, listing sequences in `order` or as added.
+        """
+        self.finish()
+        order = order or self._names
+        index_size = sum(1 + len(name.encode("ascii")) + 4 for name in order)
+        header_size = 16 + index_size
+        if header_size + self._records.tell() > MAX_FILE_SIZE:
+            raise ValueError("Sequence too large for a 2bit file: %s" % self.out_file)
+        tmp_file = "%s.tmp%s" % (self.out_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as out_handle:
+                out_handle.write(struct.pack("<IIII", SIGNATURE, 0, len(order), 0))
+                for name in order:
+                    name_bytes = name.encode("ascii")
+                    out_handle.write(struct.pack("<B", len(name_bytes)) + name_bytes +
+                                     struct.pack("<I", header_size + self._offsets[name]))
+                self._records.seek(0)
+                shutil.copyfileobj(self._records, out_handle, CHUNK_SIZE)
+            shutil.move(tmp_file, self.out_file)
+        finally:
+            self._records.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def _unpack_table():
+    table = []
+    for i in range(256):
+        table.append(b"".join(BASES[(i >> shift) & 3:((i >> shift) & 3) + 1]
+                              for shift in (6, 4, 2, 0)))
+    return table
+
+
+class TwoBitFile:
+    """Memory mapped 2bit file, retrieving sequence lengths and regions.
+    """
+    def __init__(self, in_file):
+        self._handle = open(in_file, "rb")
+        self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count, _ = struct.unpack("<IIII", self._map[:16])
+        if signature != SIGNATURE:
+            raise ValueError("Not a little endian 2bit file: %s" % in_file)
+        self.offsets = {}
+        self.names = []
+        pos = 16
+        for _ in range(count):
+            name_size = struct.unpack("<B", self._map[pos:pos + 1])[0]
+            name = self._map[pos + 1:pos + 1 + name_size].decode("ascii")
+            self.offsets[name] = struct.unpack("<I", self._map[pos + 1 + name_size:
+                                                                pos + 5 + name_size])[0]
+            self.names.append(name)
+            pos += 5 + name_size
+        self._unpack = None
+
+    def close(self):
+        self._map.close()
+        self._handle.close()
+
+    def _blocks(self, pos):
+        count = struct.unpack("<I", self._map[pos:pos + 4])[0]
+        starts = struct.unpack("<%sI" % count, self._map[pos + 4:pos + 4 + 4 * count])
+        sizes = struct.unpack("<%sI" % count, self._map[pos + 4 + 4 * count:pos + 4 + 8 * count])
+        return list(zip(starts, sizes)), pos + 4 + 8 * count
+
+    def _record(self, name):
+        pos = self.offsets[name]
+        size = struct.unpack("<I", self._map[pos:pos + 4])[0]
+        n_blocks, pos = self._blocks(pos + 4)
+        mask_blocks, pos = self._blocks(pos)
+        return size, n_blocks, mask_blocks, pos + 4
+
+    def length(self, name):
+        return self._record(name)[0]
+
+    def get(self, name, start=0, end=None, mask=True):
+        """Retrieve bases of a sequence from start to end, zero based and half open.
+        """
+        size, n_blocks, mask_blocks, dna_pos = self._record(name)
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return b""
+        packed = self._map[dna_pos + start // 4:dna_pos + (end + 3) // 4]
+        if numpy is not None:
+            codes = numpy.frombuffer(packed, dtype=numpy.uint8)
+            codes = numpy.column_stack([(codes >> s) & 3 for s in (6, 4, 2, 0)]).ravel()
+            seq = bytearray(numpy.frombuffer(BASES, dtype=numpy.uint8)[codes].tobytes())
+        else:
+            if self._unpack is None:
+                self._unpack = _unpack_table()
+            seq = bytearray(b"".join(self._unpack[b] for b in bytearray(packed)))
+        seq = seq[start % 4:start % 4 + end - start]
+        for block_start, block_size in n_blocks:
+            s, e = max(block_start, start), min(block_start + block_size, end)
+            if s < e:
+                seq[s - start:e - start] = b"N" * (e - s)
+        if mask:
+            for block_start, block_size in mask_blocks:
+                s, e = max(block_start, start), min(block_start + block_size, end)
+                if s < e:
+                    seq[s - start:e - start] = bytes(seq[s - start:e - start]).lower()
+        return bytes(seq)
+
+
+def fasta_to_twobit(in_file, out_file):
+    """Convert a FASTA file into 2bit format, with sequences in file order.
+    """
+    writer = TwoBitWriter(out_file)
+    with open(in_file, "rb") as in_handle:
+        for line in in_handle:
+            line = line.rstrip()
+            if line.startswith(b">"):
+                writer.start(line[1:].split()[0].decode("ascii"))
+            elif line:
+                writer.add(line)
+    writer.close()
+
+
+def twobit_to_fasta(in_file, out_file, width=60):
+    twobit = TwoBitFile(in_file)
+    try:
+        with open(out_file, "wb") as out_handle:
+            for name in twobit.names:
+                out_handle.write(b">" + name.encode("ascii") + b"\n")
+                size = twobit.length(name)
+                step = width * (CHUNK_SIZE // width)
+                for start in range(0, size, step):
+                    seq = twobit.get(name, start, min(start + step, size))
+                    out_handle.write(b"\n".join(seq[i:i + width]
+                                                for i in range(0, len(seq), width)) + b"\n")
+    finally:
+        twobit.close()
+
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [--to-fasta] in_file out_file")
+    parser.add_option("--to-fasta", dest="to_fasta", action="store_true", default=False,
+                      help="Convert a 2bit file into FASTA")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("Specify input and output files")
+    if options.to_fasta:
+        twobit_to_fasta(args[0], args[1])
+    else:
+        fasta_to_twobit(args[0], args[1])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,302 @@
+"""Content addressed file caches kept on the machine running fabric.
+
+Downloaded source tarballs are stored by a key computed from the URL and an
+optional checksum. On a cache hit the file is pushed to the target instead of
+downloaded again; on a miss the target downloads it and a copy is pulled back
+into the cache. The cache directory can be on a shared filesystem to reuse
+downloads across machines running fabric.
+
+Caches are trimmed to a maximum size by removing least recently used entries.
+In offline mode a miss fails immediately instead of downloading. Checksums,
+passed by callers or listed in a checksum file, are verified on every
+download, whether or not it is cached.
+
+Configuration, in fabricrc.txt:
+
+  - download_cache_dir -- Directory to keep downloads in; caching is disabled if unset.
+  - download_cache_max_size -- Maximum size of the cache, like 20G or 500M.
+  - download_cache_offline -- Only use cached downloads, failing on misses.
+  - download_checksums -- File of expected checksums for downloads, in sha256sum format.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from fabric.api import env, put, get, settings, hide
+
+from cloudbio import trace
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+_STATS = {}
+_CHECKSUMS = {}
+
+
+def parse_size(size):
+    """Convert a size like 20G or 500M into bytes.
+    """
+    if size is None or size == "":
+        return None
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+class FileCache:
+    """Directory of files stored by key, with least recently used eviction.
+
+    Each entry lives in its own directory with a small JSON metadata file, so
+    multiple fabric processes can share a cache without a global index.
+    """
+    def __init__(self, cache_dir, max_size=None, name="download"):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = parse_size(max_size)
+        self.name = name
+        self.stats = _STATS.setdefault(self.cache_dir, {"hits": 0, "misses": 0})
+
+    def key(self, *parts):
+        return hashlib.sha1("\0".join(str(p) for p in parts)).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _metadata(self, key):
+        return os.path.join(self._entry_dir(key), "metadata.json")
+
+    def get(self, key):
+        """Retrieve the cached file for a key, or None if not present.
+        """
+        meta_file = self._metadata(key)
+        if os.path.exists(meta_file):
+            with open(meta_file) as in_handle:
+                meta = json.load(in_handle)
+            cached = os.path.join(self._entry_dir(key), meta["file"])
+            if os.path.exists(cached):
+                # track usage for least recently used eviction
+                os.utime(meta_file, None)
+                self.stats["hits"] += 1
+                return cached
+        self.stats["misses"] += 1
+        return None
+
+    def add(self, key, local_file, name, source=None):
+        """Move a local file into the cache, returning the cached path.
+        """
+        entry_dir = self._entry_dir(key)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        cached = os.path.join(entry_dir, name)
+        shutil.move(local_file, cached)
+        meta = {"file": name, "source": source, "size": os.path.getsize(cached),
+                "added": time.time()}
+        tmp_meta = "%s.tmp%s" % (self._metadata(key), os.getpid())
+        with open(tmp_meta, "w") as out_handle:
+            json.dump(meta, out_handle)
+        os.rename(tmp_meta, self._metadata(key))
+        self.evict()
+        return cached
+
+    def _entries(self):
+        """Retrieve (last used, size, entry directory) for all cache entries.
+        """
+        entries = []
+        if os.path.exists(self.cache_dir):
+            for prefix in os.listdir(self.cache_dir):
+                prefix_dir = os.path.join(self.cache_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for key in os.listdir(prefix_dir):
+                    meta_file = self._metadata(key)
+                    if os.path.exists(meta_file):
+                        with open(meta_file) as in_handle:
+                            size = json.load(in_handle).get("size", 0)
+                        entries.append((os.path.getmtime(meta_file), size,
+                                        os.path.join(prefix_dir, key)))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size.
+        """
+        if not self.max_size:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for (_, size, _) in entries)
+        while entries and total > self.max_size:
+            _, size, entry_dir = entries.pop(0)
+            env.logger.debug("Evicting %s from %s cache" % (entry_dir, self.name))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+@contextmanager
+def locked(lock_file):
+    """Hold an exclusive lock on a file, shared between fabric processes.
+    """
+    lock_dir = os.path.dirname(lock_file)
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    with open(lock_file, "w") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def download_cache():
+    """Retrieve the configured download cache, or None if caching is disabled.
+    """
+    cache_dir = env.get("download_cache_dir", None)
+    if not cache_dir:
+        return None
+    return FileCache(cache_dir, env.get("download_cache_max_size", None))
+
+
+def take_stats():
+    """Retrieve cache hit and miss counts, resetting them to zero.
+
+    Used to pass counts from jobs in child processes back to the parent.
+    """
+    taken = {}
+    for cache_dir, stats in _STATS.items():
+        taken[cache_dir] = dict(stats)
+        stats["hits"] = stats["misses"] = 0
+    return taken
+
+
+def merge_stats(other):
+    """Add counts retrieved with take_stats in another process.
+    """
+    for cache_dir, stats in (other or {}).items():
+        cur = _STATS.setdefault(cache_dir, {"hits": 0, "misses": 0})
+        for key in ["hits", "misses"]:
+            cur[key] += stats.get(key, 0)
+
+
+def log_stats():
+    for cache_dir, stats in sorted(_STATS.items()):
+        total = stats["hits"] + stats["misses"]
+        if total:
+            env.logger.info("Cache %s: %s hits, %s misses (%.0f%% hit rate)"
+                            % (cache_dir, stats["hits"], stats["misses"],
+                               100.0 * stats["hits"] / total))
+
+
+def _split_checksum(checksum):
+    """Split a checksum like sha256:abc... into algorithm and digest, defaulting to sha256.
+    """
+    if ":" in checksum:
+        algorithm, expected = checksum.split(":", 1)
+    else:
+        algorithm, expected = "sha256", checksum
+    return algorithm.lower(), expected.strip().lower()
+
+
+def _checksum_ok(local_file, checksum):
+    """Verify a local file against a checksum.
+    """
+    algorithm, expected = _split_checksum(checksum)
+    hasher = hashlib.new(algorithm)
+    with open(local_file, "rb") as in_handle:
+        for chunk in iter(lambda: in_handle.read(1024 * 1024), ""):
+            hasher.update(chunk)
+    return hasher.hexdigest() == expected
+
+
+def _remote_checksum_ok(out_file, checksum):
+    """Verify a file on the target against a checksum with md5sum, sha256sum and friends.
+    """
+    algorithm, expected = _split_checksum(checksum)
+    with settings(hide('everything'), warn_only=True):
+        out = env.safe_run_output("%ssum %s" % (algorithm, out_file))
+    return out.succeeded and out.split()[:1] == [expected]
+
+
+def _configured_checksum(url, out_file):
+    """Retrieve a checksum for a download from the ``download_checksums`` file.
+
+    The file is in sha256sum format, with the URL or file name of each download
+    in place of the file name. Digests may be prefixed by an algorithm, like md5:.
+    """
+    fname = env.get("download_checksums", None)
+    if not fname:
+        return None
+    fname = os.path.expanduser(fname)
+    if fname not in _CHECKSUMS:
+        checksums = {}
+        with open(fname) as in_handle:
+            for line in in_handle:
+                parts = line.split()
+                if len(parts) == 2 and not line.startswith("#"):
+                    checksums[parts[1].lstrip("*")] = parts[0]
+        _CHECKSUMS[fname] = checksums
+    return _CHECKSUMS[fname].get(url) or _CHECKSUMS[fname].get(os.path.basename(out_file))
+
+
+def _offline():
+    return str(env.get("download_cache_offline", "false")).lower() in ["true", "yes"]
+
+
+def _remote_path(fname):
+    if os.path.isabs(fname) or not env.get("cwd"):
+        return fname
+    return os.path.join(env.cwd, fname)
+
+
+def fetch(url, out_file, checksum=None, run_fn=None, cache=None):
+    """Retrieve a URL into out_file on the target, using the download cache.
+
+    `run_fn` runs the download command on a miss, defaulting to env.safe_run.
+    """
+    with trace.span("download %s" % os.path.basename(out_file), "download", url=url):
+        _fetch(url, out_file, checksum, run_fn, cache)
+
+
+def _fetch(url, out_file, checksum, run_fn, cache):
+    if run_fn is None:
+        run_fn = env.safe_run
+    checksum = checksum or _configured_checksum(url, out_file)
+    wget_cmd = "wget --no-check-certificate -O %s '%s'" % (out_file, url)
+    if cache is None:
+        cache = download_cache()
+    if cache is None:
+        if _offline():
+            raise IOError("Offline mode: no download cache configured to retrieve %s" % url)
+        run_fn(wget_cmd)
+        if checksum and not _remote_checksum_ok(out_file, checksum):
+            run_fn("rm -f %s" % out_file)
+            raise IOError("Checksum mismatch for %s: expected %s" % (url, checksum))
+        return
+    key = cache.key(url, checksum or "")
+    cached = cache.get(key)
+    if cached and checksum and not _checksum_ok(cached, checksum):
+        env.logger.warn("Cached download of %s does not match its checksum; downloading again"
+                        % url)
+        cached = None
+    put_fn = env.get("safe_put") or put
+    if cached:
+        env.logger.debug("Using cached download of %s" % url)
+        put_fn(cached, _remote_path(out_file))
+        return
+    if _offline():
+        raise IOError("Offline mode: %s not present in download cache %s" % (url, cache.cache_dir))
+    run_fn(wget_cmd)
+    get_fn = env.get("safe_get") or get
+    fd, local_file = tempfile.mkstemp(dir=cache.cache_dir if os.path.exists(cache.cache_dir)
+                                      else None)
+    os.close(fd)
+    try:
+        get_fn(_remote_path(out_file), local_file)
+        if checksum and not _checksum_ok(local_file, checksum):
+            run_fn("rm -f %s" % out_file)
+            raise IOError("Checksum mismatch for %s: expected %s" % (url, checksum))
+        cache.add(key, local_file, os.path.basename(out_file), url)
+    finally:
+        if os.path.exists(local_file):
+            os.remove(local_file)
@@ -737,7 +737,7 @@ def install_bamtools(env):
         env.safe_run("mkdir build")
         with cd("build"):
             env.safe_run("cmake ..")
-            env.safe_run("make")
+            env.safe_run(shared._make_cmd())
         env.safe_sudo("cp bin/* %s" % shared._get_bin_dir(env))
         env.safe_sudo("cp lib/* %s" % shared._get_lib_dir(env))
     _get_install(repository, env, _cmake_bamtools,
@@ -2,6 +2,7 @@
 """
 import tempfile
 import os
+import re
 import functools
 import urllib
 from tempfile import NamedTemporaryFile
@@ -10,6 +11,7 @@ from contextlib import contextmanager
 
 from fabric.api import *
 from fabric.contrib.files import *
+from cloudbio import artifacts, cache, hostfacts, trace
 from cloudbio.fabutils import quiet
 
 CBL_REPO_ROOT_URL = "https://raw.github.com/chapmanb/cloudbiolinux/master/"
@@ -36,12 +38,17 @@ def _if_not_installed(pname):
 
 
 def _executable_not_on_path(pname):
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True):
-        result = env.safe_run("export PATH=$PATH:%s/bin && "
-                              "export LD_LIBRARY_PATH=%s/lib:$LD_LIBRARY_PATH && %s" %
-                              (env.system_install, env.system_install, pname))
-    return result.return_code == 127
+    return _executables_not_on_path([pname])[pname]
+
+
+def _executables_not_on_path(pnames):
+    """Check a group of programs for presence on the path with one remote call.
+
+    Returns a dictionary of program names to True when the program is missing.
+    Results are cached per host until a command that installs software runs.
+    """
+    found = hostfacts.executables_on_path(pnames)
+    return dict((p, not f) for p, f in found.iteritems())
 
 
 def _galaxy_tool_install(args):
@@ -78,7 +85,7 @@ def _make_tmp_dir():
     remote path $TMPDIR/cloudbiolinux if $TMPDIR is defined remotely, finally falling
     back on remote $HOME/cloudbiolinux otherwise.
     """
-    work_dir = __work_dir()
+    work_dir = _work_dir()
     use_sudo = False
     if not env.safe_exists(work_dir):
         with settings(warn_only=True):
@@ -96,15 +103,13 @@ def _make_tmp_dir():
         run_func("rm -rf %s" % work_dir)
 
 
-def __work_dir():
+def _work_dir():
     work_dir = env.get("work_dir", None)
     if not work_dir:
-        with quiet():
-            tmp_dir = env.safe_run_output("echo $TMPDIR")
-        if tmp_dir.failed or not tmp_dir.strip():
-            home_dir = env.safe_run_output("echo $HOME")
-            tmp_dir = os.path.join(home_dir, "tmp")
-        work_dir = os.path.join(tmp_dir.strip(), "cloudbiolinux")
+        tmp_dir = hostfacts.tmp_dir()
+        if not tmp_dir:
+            tmp_dir = os.path.join(hostfacts.home_dir(), "tmp")
+        work_dir = os.path.join(tmp_dir, "cloudbiolinux")
     return work_dir
 
 
@@ -132,9 +137,9 @@ def _get_expected_file(url, dir_name=None, safe_tar=False, tar_file_name=None):
 
 def _safe_dir_name(dir_name, need_dir=True):
     replace_try = ["", "-src", "_core"]
-    for replace in replace_try:
-        check = dir_name.replace(replace, "")
-        if env.safe_exists(check):
+    checks = [dir_name.replace(replace, "") for replace in replace_try]
+    for check, found in zip(checks, env.safe_probe([("exists", c) for c in checks])):
+        if found:
             return check
     # still couldn't find it, it's a nasty one
     for check_part in (dir_name.split("-")[0].split("_")[0],
@@ -152,7 +157,7 @@ def _safe_dir_name(dir_name, need_dir=True):
 
 
 def _fetch_and_unpack(url, need_dir=True, dir_name=None, revision=None,
-                      safe_tar=False, tar_file_name=None):
+                      safe_tar=False, tar_file_name=None, checksum=None):
     if url.startswith(("git", "svn", "hg", "cvs")):
         base = os.path.splitext(os.path.basename(url.split()[-1]))[0]
         if env.safe_exists(base):
@@ -168,7 +173,7 @@ def _fetch_and_unpack(url, need_dir=True, dir_name=None, revision=None,
         # If tar_file_name is provided, use it instead of the inferred one
         tar_file, dir_name, tar_cmd = _get_expected_file(url, dir_name, safe_tar, tar_file_name=tar_file_name)
         if not env.safe_exists(tar_file):
-            env.safe_run("wget --no-check-certificate -O %s '%s'" % (tar_file, url))
+            cache.fetch(url, tar_file, checksum)
         env.safe_run("%s %s" % (tar_cmd, tar_file))
         return _safe_dir_name(dir_name, need_dir)
 
@@ -177,7 +182,7 @@ def _configure_make(env):
     env.safe_run("export PKG_CONFIG_PATH=$PKG_CONFIG_PATH:%s/lib/pkgconfig && " \
                  "./configure --disable-werror --prefix=%s " %
                  (env.system_install, env.system_install))
-    env.safe_run("make")
+    env.safe_run(_make_cmd())
     env.safe_sudo("make install")
 
 
@@ -186,7 +191,7 @@ def _make_copy(find_cmd=None, premake_cmd=None, do_make=True):
         if premake_cmd:
             premake_cmd()
         if do_make:
-            env.safe_run("make")
+            env.safe_run(_make_cmd())
         if find_cmd:
             install_dir = _get_bin_dir(env)
             for fname in env.safe_run_output(find_cmd).split("\n"):
@@ -195,21 +200,29 @@ def _make_copy(find_cmd=None, premake_cmd=None, do_make=True):
 
 
 def _get_install(url, env, make_command, post_unpack_fn=None, revision=None, dir_name=None,
-                 safe_tar=False, tar_file_name=None):
+                 safe_tar=False, tar_file_name=None, checksum=None):
     """Retrieve source from a URL and install in our system directory.
     """
+    key = artifacts.artifact_key(url, revision, make_command, post_unpack_fn)
     with _make_tmp_dir() as work_dir:
+        if artifacts.restore(key, work_dir):
+            return
+        stamp = artifacts.start(key, work_dir)
         with cd(work_dir):
             dir_name = _fetch_and_unpack(url, revision=revision, dir_name=dir_name,
-                                         safe_tar=safe_tar, tar_file_name=tar_file_name)
+                                         safe_tar=safe_tar, tar_file_name=tar_file_name,
+                                         checksum=checksum)
         with cd(os.path.join(work_dir, dir_name)):
             if post_unpack_fn:
                 post_unpack_fn(env)
-            make_command(env)
+            with _build_accel(), trace.span("build %s" % dir_name, "build", url=url):
+                make_command(env)
+        artifacts.capture(key, stamp, work_dir, url, [env.system_install])
 
 
 def _get_install_local(url, env, make_command, dir_name=None,
-                       post_unpack_fn=None, safe_tar=False, tar_file_name=None):
+                       post_unpack_fn=None, safe_tar=False, tar_file_name=None,
+                       checksum=None):
     """Build and install in a local directory.
     """
     (_, test_name, _) = _get_expected_file(url, safe_tar=safe_tar, tar_file_name=tar_file_name)
@@ -220,22 +233,142 @@ def _get_install_local(url, env, make_command, dir_name=None,
         test2, _ = test1.rsplit("-", 1)
     else:
         test2 = os.path.join(env.local_install, test_name.split("_")[0])
-    if not env.safe_exists(test1) and not env.safe_exists(test2):
+    if not any(env.safe_probe([("exists", test1), ("exists", test2)])):
+        key = artifacts.artifact_key(url, None, make_command, post_unpack_fn)
         with _make_tmp_dir() as work_dir:
+            if artifacts.restore(key, work_dir):
+                return
+            stamp = artifacts.start(key, work_dir)
             with cd(work_dir):
                 dir_name = _fetch_and_unpack(url, dir_name=dir_name, safe_tar=safe_tar,
-                    tar_file_name=tar_file_name)
+                    tar_file_name=tar_file_name, checksum=checksum)
                 print env.local_install, dir_name
                 if not env.safe_exists(os.path.join(env.local_install, dir_name)):
                     with cd(dir_name):
                         if post_unpack_fn:
                             post_unpack_fn(env)
-                        make_command(env)
+                        with _build_accel(), trace.span("build %s" % dir_name, "build", url=url):
+                            make_command(env)
                     # Copy instead of move because GNU mv does not have --parents flag.
                     # The source dir will get cleaned up anyhow so just leave it.
                     destination_dir = env.local_install
                     env.safe_sudo("mkdir -p '%s'" % destination_dir)
                     env.safe_sudo("cp --recursive %s %s" % (dir_name, destination_dir))
+            artifacts.capture(key, stamp, work_dir, url, [env.system_install, env.local_install])
+
+# --- Build acceleration
+
+CCACHE_COMPILERS = ["cc", "gcc", "c++", "g++"]
+
+
+def _make_jobs():
+    """Number of parallel make jobs, from `make_jobs`.
+
+    Builds are serial by default, since older makefiles may not be safe to
+    run in parallel. `auto` uses the cores on the target, shared between
+    concurrent builds.
+    """
+    setting = str(env.get("make_jobs", 1))
+    if setting.lower() == "auto":
+        return max(hostfacts.cores() // int(env.get("build_workers", 1)), 1)
+    return max(int(setting), 1)
+
+
+def _make_cmd(target=""):
+    jobs = _make_jobs()
+    cmd = "make -j %s" % jobs if jobs > 1 else "make"
+    return ("%s %s" % (cmd, target)).strip()
+
+
+def _ccache_bin():
+    """Directory of compiler links that run through ccache, or None if unavailable.
+
+    Uses the distribution provided directory if present, otherwise creates
+    links in ~/.cloudbiolinux/ccache. Disable with `build_ccache = False`.
+    """
+    if str(env.get("build_ccache", "true")).lower() not in ["true", "yes"]:
+        return None
+    def _retrieve():
+        if not hostfacts.executables_on_path(["ccache"])["ccache"]:
+            return None
+        dist_dirs = ["/usr/lib/ccache", "/usr/lib64/ccache"]
+        for dist_dir, present in zip(dist_dirs, env.safe_probe([("exists", os.path.join(d, "gcc"))
+                                                                for d in dist_dirs])):
+            if present:
+                return dist_dir
+        bin_dir = os.path.join(hostfacts.home_dir(), ".cloudbiolinux", "ccache")
+        env.safe_run("mkdir -p %s" % bin_dir)
+        for compiler in CCACHE_COMPILERS:
+            env.safe_run("ln -sf $(which ccache) %s" % os.path.join(bin_dir, compiler))
+        return bin_dir
+    bin_dir = hostfacts.get_fact("ccache_bin", _retrieve)
+    if bin_dir:
+        hostfacts.get_fact("ccache_start", _ccache_stats)
+    return bin_dir
+
+
+@contextmanager
+def _build_accel():
+    """Run builds with compilers going through ccache when available.
+
+    CCACHE_BASEDIR makes paths inside the build directory relative, so
+    rebuilds in a fresh temporary directory still hit the cache.
+    """
+    bin_dir = _ccache_bin()
+    if bin_dir:
+        with path(bin_dir, behavior="prepend"):
+            with shell_env(CCACHE_BASEDIR=_work_dir()):
+                yield
+    else:
+        yield
+
+
+def _ccache_stats():
+    """Retrieve ccache hit and miss counts, handling ccache 3 and 4 output.
+    """
+    stats = {}
+    with quiet():
+        out = env.safe_run_output("ccache -s")
+    if out.failed:
+        return stats
+    patterns = [("hits", re.compile(r"^cache hit \((?:direct|preprocessed)\)\s+(\d+)")),
+                ("misses", re.compile(r"^cache miss\s+(\d+)"))]
+    for line in out.split("\n"):
+        line = line.strip().lower()
+        for key, pattern in patterns:
+            match = pattern.search(line)
+            if match:
+                stats[key] = stats.get(key, 0) + int(match.group(1))
+        # ccache 4 summary lines; the first occurrence covers all storage
+        for key in ["hits", "misses"]:
+            match = re.search(r"^%s:\s+(\d+)" % key, line)
+            if match and ("%s4" % key) not in stats:
+                stats["%s4" % key] = int(match.group(1))
+    for key in ["hits", "misses"]:
+        if ("%s4" % key) in stats:
+            stats[key] = stats.pop("%s4" % key)
+    return stats
+
+
+def ccache_run_stats():
+    """Compiler cache hits and misses for builds during this run, or None if not used.
+    """
+    start = hostfacts.get_fact("ccache_start", lambda: None)
+    if start is None:
+        return None
+    end = _ccache_stats()
+    return {"hits": end.get("hits", 0) - start.get("hits", 0),
+            "misses": end.get("misses", 0) - start.get("misses", 0)}
+
+
+def log_ccache_stats():
+    """Report compiler cache hits and misses for builds during this run.
+    """
+    stats = ccache_run_stats()
+    if stats and stats["hits"] + stats["misses"] > 0:
+        env.logger.info("Compiler cache: %s hits, %s misses (%.0f%% hit rate)"
+                        % (stats["hits"], stats["misses"],
+                           100.0 * stats["hits"] / (stats["hits"] + stats["misses"])))
 
 # --- Language specific utilities
 
@@ -248,22 +381,24 @@ def _symlinked_shared_dir(pname, version, env, extra_dir=None):
     else:
         base_dir = os.path.join(env.system_install, "share", pname)
     install_dir = "%s-%s" % (base_dir, version)
+    install_exists, base_exists = env.safe_probe([("exists", install_dir),
+                                                  ("exists", base_dir)])
     # Does not exist, change symlink to new directory
-    if not env.safe_exists(install_dir):
+    if not install_exists:
         env.safe_sudo("mkdir -p %s" % install_dir)
-        if env.safe_exists(base_dir):
+        if base_exists:
             env.safe_sudo("rm -f %s" % base_dir)
         env.safe_sudo("ln -s %s %s" % (install_dir, base_dir))
         return install_dir
     items = env.safe_run_output("ls %s" % install_dir)
     # empty directory, change symlink and re-download
     if items.strip() == "":
-        if env.safe_exists(base_dir):
+        if base_exists:
             env.safe_sudo("rm -f %s" % base_dir)
         env.safe_sudo("ln -s %s %s" % (install_dir, base_dir))
         return install_dir
     # Create symlink if previously deleted
-    if not env.safe_exists(base_dir):
+    if not base_exists:
         env.safe_sudo("ln -s %s %s" % (install_dir, base_dir))
     return None
 
@@ -296,6 +431,9 @@ def _java_install(pname, version, url, env, install_fn=None,
 def _python_cmd(env):
     """Retrieve python command, handling tricky situations on CentOS.
     """
+    return hostfacts.get_fact("python_cmd", lambda: _find_python_cmd(env))
+
+def _find_python_cmd(env):
     anaconda_py = os.path.join(env.system_install, "anaconda", "bin", "python")
     if env.safe_exists(anaconda_py):
         return anaconda_py
@@ -312,6 +450,9 @@ def _python_cmd(env):
 def _pip_cmd(env):
     """Retrieve pip command for installing python packages, allowing configuration.
     """
+    return hostfacts.get_fact("pip_cmd", lambda: _find_pip_cmd(env))
+
+def _find_pip_cmd(env):
     anaconda_pip = os.path.join(env.system_install, "anaconda", "bin", "pip")
     if env.safe_exists(anaconda_pip):
         to_check = [anaconda_pip]
@@ -331,6 +472,9 @@ def _pip_cmd(env):
     raise ValueError("Could not find pip installer from: %s" % to_check)
 
 def _conda_cmd(env):
+    return hostfacts.get_fact("conda_cmd", lambda: _find_conda_cmd(env))
+
+def _find_conda_cmd(env):
     to_check = [os.path.join(env.system_install, "anaconda", "bin", "conda"), "conda"]
     for cmd in to_check:
         with quiet():
@@ -342,6 +486,9 @@ def _conda_cmd(env):
 def _is_anaconda(env):
     """Check if we have a conda command or are in an anaconda subdirectory.
     """
+    return hostfacts.get_fact("is_anaconda", lambda: _check_anaconda(env))
+
+def _check_anaconda(env):
     with quiet():
         conda = _conda_cmd(env)
         has_conda = conda and env.safe_run_output("%s -h" % conda).startswith("usage: conda")
@@ -424,11 +571,13 @@ def _set_default_config(env, install_dir, sym_dir_name="default"):
     when it doesn't exists or when installing a new version of software.
     """
     version = env["tool_version"]
-    if env.safe_exists(install_dir):
-        install_dir_root = "%s/.." % install_dir
-        sym_dir = "%s/%s" % (install_dir_root, sym_dir_name)
+    install_dir_root = "%s/.." % install_dir
+    sym_dir = "%s/%s" % (install_dir_root, sym_dir_name)
+    install_exists, sym_exists = env.safe_probe([("exists", install_dir),
+                                                 ("exists", sym_dir)])
+    if install_exists:
         replace_default = False
-        if not env.safe_exists(sym_dir):
+        if not sym_exists:
             replace_default = True
         if not replace_default:
             default_version = env.safe_sudo("basename `readlink -f %s`" % sym_dir)
@@ -525,8 +674,9 @@ def _add_to_profiles(line, profiles=[], use_sudo=True):
     """
     if not profiles:
         profiles = ['/etc/bash.bashrc', '/etc/profile']
-    for profile in profiles:
-        if not env.safe_contains(profile, line):
+    present = env.safe_probe([("contains", profile, line) for profile in profiles])
+    for profile, has_line in zip(profiles, present):
+        if not has_line:
             env.safe_append(profile, line, use_sudo=use_sudo)
 
 
@@ -2,9 +2,11 @@ from string import Template
 from time import strftime
 import os
 
-from fabric.api import local, sudo, env, put, get
+from fabric.api import sudo, env
 from fabric.contrib.files import exists, append
 
+from cloudbio import cache
+
 
 def setup_install_dir():
     """Sets up install dir and ensures its owned by Galaxy"""
@@ -45,15 +47,11 @@ def wget(url, install_command=sudo, file_name=None):
         if '?' in file_name:
             file_name = file_name[0:file_name.index('?')]
     if ("cache_source_downloads" in env) and (not env.cache_source_downloads):
+        download_cache = None
+    else:
+        cache_dir = env.get("download_cache_dir") or env.get("source_cache_dir") or ".downloads"
+        download_cache = cache.FileCache(cache_dir, env.get("download_cache_max_size", None))
+    if download_cache is None:
         install_command("wget %s -O %s" % (url, file_name))
     else:
-        cache_dir = env.source_cache_dir
-        if not cache_dir:
-            cache_dir = ".downloads"
-        cached_file = os.path.join(cache_dir, file_name)
-        if os.path.exists(cached_file):
-            put(cached_file, file_name)
-        else:
-            install_command("wget %s -O %s" % (url, file_name))
-            local("mkdir -p '%s'" % cache_dir)
-            get(file_name, cached_file)
+        cache.fetch(url, file_name, run_fn=install_command, cache=download_cache)
@@ -8,6 +8,7 @@ import subprocess
 
 from fabric.api import env
 
+from cloudbio import hostfacts
 from cloudbio.fabutils import quiet
 from cloudbio.fabutils import configure_runsudo
 
@@ -48,12 +49,12 @@ def _setup_distribution_environment(ignore_distcheck=False):
     _setup_nixpkgs()
     _setup_fullpaths(env)
     # allow us to check for packages only available on 64bit machines
-    machine = env.safe_run_output("uname -m")
+    machine = hostfacts.machine()
     env.is_64bit = machine.find("_64") > 0
 
 
 def _setup_fullpaths(env):
-    home_dir = env.safe_run_output("echo $HOME")
+    home_dir = hostfacts.home_dir()
     for attr in ["data_files", "galaxy_home", "local_install"]:
         if hasattr(env, attr):
             x = getattr(env, attr)
@@ -10,14 +10,18 @@ Handles:
     - safe_sudo: Run a command as sudo user
     - safe_exists: Check for existence of a file.
     - safe_sed: Run sed command.
+    - safe_probe: Answer a batch of exists/contains/executable checks in
+      a single remote call.
 """
 import hashlib
 import re
 import shutil
 
-from fabric.api import env, run, sudo, local, settings, hide, put
+from fabric.api import env, run, sudo, local, settings, hide, put, get
 from fabric.contrib.files import exists, sed, contains, append, comment
 
+from cloudbio import hostfacts, trace
+
 SUDO_ENV_KEEPS = []  # Environment variables passed through to sudo environment when using local sudo.
 SUDO_ENV_KEEPS += ["http_proxy", "https_proxy"]  # Required for local sudo to work behind a proxy.
 
@@ -47,6 +51,9 @@ def run_local(use_sudo=False, capture=False):
 def local_put(orig_file, new_file):
     shutil.copyfile(orig_file, new_file)
 
+def local_get(remote_file, local_file):
+    shutil.copyfile(remote_file, local_file)
+
 def local_sed(filename, before, after, limit='', use_sudo=False, backup='.bak',
               flags='', shell=False):
     """ Run a search-and-replace on ``filename`` with given regex patterns.
@@ -147,6 +154,59 @@ def local_append(filename, text, use_sudo=False, partial=False, escape=True, she
         line = line.replace("'", r"'\\''") if escape else line
         func("echo '%s' >> %s" % (line, _expand_path(filename)))
 
+# ## Batched remote checks
+
+PROBE_MARKER = "__cbl_probe__"
+
+def _probe_test(check):
+    """Shell test for a single check, exiting zero when the check passes.
+    """
+    kind = check[0]
+    if kind == "exists":
+        return 'test -e %s' % _expand_path(check[1])
+    elif kind == "contains":
+        filename, text = check[1], check[2]
+        exact = check[3] if len(check) > 3 else False
+        text = _escape_for_regex(text)
+        if exact:
+            text = "^%s$" % text
+        return 'egrep "%s" %s' % (text, _expand_path(filename))
+    elif kind == "executable":
+        # Mirror the shell lookup: anything named like the program on the PATH
+        # (or in the system install bin directory) counts as installed.
+        program = check[1].split()[0]
+        return ('(IFS=:; for d in $PATH:%s/bin; do test -f "$d/%s" && exit 0; done; exit 1)'
+                % (env.system_install, program))
+    else:
+        raise ValueError("Unexpected probe type: %s" % kind)
+
+def batch_probe(checks):
+    """Answer many remote checks with a single shell invocation.
+
+    `checks` is a list of tuples, one of:
+      - ("exists", path)
+      - ("contains", filename, text[, exact])
+      - ("executable", program)
+
+    Returns a list of booleans in the same order as the checks.
+    """
+    if not checks:
+        return []
+    cmds = ['%s >/dev/null 2>&1; echo "%s %i $?"' % (_probe_test(c), PROBE_MARKER, i)
+            for i, c in enumerate(checks)]
+    with settings(hide('everything'), warn_only=True):
+        env.lcwd = env.cwd
+        out = env.safe_run_output("; ".join(cmds))
+    results = [None] * len(checks)
+    for line in out.split("\n"):
+        parts = line.strip().split()
+        if len(parts) == 3 and parts[0] == PROBE_MARKER:
+            results[int(parts[1])] = parts[2] == "0"
+    missing = [checks[i] for i, r in enumerate(results) if r is None]
+    if missing:
+        raise ValueError("Did not retrieve results for remote checks: %s" % missing)
+    return results
+
 def configure_runsudo(env):
     """Setup env variable with safe_sudo and safe_run,
     supporting non-privileged users and local execution.
@@ -154,6 +214,7 @@ def configure_runsudo(env):
     env.is_local = env.hosts == ["localhost"]
     if env.is_local:
         env.safe_put = local_put
+        env.safe_get = local_get
         env.safe_sed = local_sed
         env.safe_comment = local_comment
         env.safe_contains = local_contains
@@ -163,6 +224,7 @@ def configure_runsudo(env):
         env.safe_run_output = run_local(capture=True)
     else:
         env.safe_put = put
+        env.safe_get = get
         env.safe_sed = sed
         env.safe_comment = comment
         env.safe_contains = contains
@@ -170,6 +232,7 @@ def configure_runsudo(env):
         env.safe_exists = exists
         env.safe_run = run
         env.safe_run_output = run
+    env.safe_probe = batch_probe
     if getattr(env, "use_sudo", "true").lower() in ["true", "yes"]:
         env.use_sudo = True
         if env.is_local:
@@ -182,6 +245,12 @@ def configure_runsudo(env):
             env.safe_sudo = run_local()
         else:
             env.safe_sudo = run
+    env.safe_run = trace.traced(env.safe_run)
+    env.safe_run_output = trace.traced(env.safe_run_output)
+    env.safe_sudo = trace.traced(env.safe_sudo)
+    # Commands that change the system drop cached host facts they affect
+    env.safe_run = hostfacts.invalidating(env.safe_run)
+    env.safe_sudo = hostfacts.invalidating(env.safe_sudo)
 
 
 try:
@@ -20,6 +20,7 @@ from fabric.api import cd
 
 from cloudbio.custom.shared import _make_tmp_dir, _if_not_installed, _set_default_config
 from cloudbio.custom.shared import _get_install, _configure_make, _fetch_and_unpack, _get_bin_dir
+from cloudbio.custom.shared import _build_accel, _make_cmd
 
 
 @_if_not_installed(None)
@@ -31,20 +32,20 @@ def install_fastx_toolkit(env):
     gtext_url = "%slibgtextutils-%s.tar.bz2" % (url_base, gtext_version)
     pkg_name = 'fastx_toolkit'
     install_dir = os.path.join(env.galaxy_tools_dir, pkg_name, version)
-    with _make_tmp_dir() as work_dir:
+    with _make_tmp_dir() as work_dir, _build_accel():
         with cd(work_dir):
             env.safe_run("wget %s" % gtext_url)
             env.safe_run("tar -xjvpf %s" % (os.path.split(gtext_url)[-1]))
             install_cmd = env.safe_sudo if env.use_sudo else env.safe_run
             with cd("libgtextutils-%s" % gtext_version):
                 env.safe_run("./configure --prefix=%s" % (install_dir))
-                env.safe_run("make")
+                env.safe_run(_make_cmd())
                 install_cmd("make install")
             env.safe_run("wget %s" % fastx_url)
             env.safe_run("tar -xjvpf %s" % os.path.split(fastx_url)[-1])
             with cd("fastx_toolkit-%s" % version):
                 env.safe_run("export PKG_CONFIG_PATH=%s/lib/pkgconfig; ./configure --prefix=%s" % (install_dir, install_dir))
-                env.safe_run("make")
+                env.safe_run(_make_cmd())
                 install_cmd("make install")
 
 
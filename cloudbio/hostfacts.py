@@ -0,0 +1,139 @@
+"""Per-run cache of facts about remote hosts.
+
+Details like the home directory, machine architecture, the location of
+python, pip and conda or the programs available on the PATH are needed by
+many installers but rarely change during a run. These are retrieved once per
+host and answered from memory afterwards. Commands run through
+env.safe_run/env.safe_sudo which could change a fact (installing into a bin
+directory, setting up anaconda) invalidate the affected entries.
+"""
+import re
+
+from fabric.api import env, settings, hide
+
+_FACTS = {}
+
+PYTHON_FACTS = ["python_cmd", "pip_cmd", "conda_cmd", "is_anaconda"]
+
+# Facts derived from the programs on the PATH, invalidated along with them.
+EXECUTABLE_FACTS = ["executables", "ccache_bin"]
+
+# Commands matching a pattern invalidate the listed facts.
+INVALIDATION_RULES = [
+    (re.compile(r"anaconda-.*\.sh|miniconda|easy_install|get-pip|virtualenv|"
+                r"\b(apt-get|yum|dpkg|rpm)\b.*\b(install|remove|upgrade)\b|"
+                r"\b(install|remove)\b.*\b(pip|conda)\b", re.I),
+     PYTHON_FACTS),
+    (re.compile(r"\b(install|remove|upgrade|uninstall|mv|cp|ln|rm|tar|unzip|"
+                r"gunzip|bunzip2|chmod)\b"),
+     EXECUTABLE_FACTS),
+]
+
+
+def _host_key():
+    return env.get("host_string") or "localhost"
+
+
+def get_fact(name, retrieve_fn):
+    """Retrieve a fact for the current host, calling `retrieve_fn` on a cache miss.
+    """
+    facts = _FACTS.setdefault(_host_key(), {})
+    if name not in facts:
+        facts[name] = retrieve_fn()
+    return facts[name]
+
+
+def set_fact(name, value):
+    _FACTS.setdefault(_host_key(), {})[name] = value
+
+
+def invalidate(names=None):
+    """Remove cached facts for the current host; all facts if `names` is not given.
+    """
+    if names is None:
+        _FACTS.pop(_host_key(), None)
+    else:
+        facts = _FACTS.get(_host_key(), {})
+        for name in names:
+            for fact in (EXECUTABLE_FACTS if name == "executables" else [name]):
+                facts.pop(fact, None)
+
+
+def invalidate_for_command(command):
+    """Drop any cached facts that running `command` could change.
+    """
+    to_remove = set([])
+    for pattern, names in INVALIDATION_RULES:
+        if pattern.search(command):
+            to_remove.update(names)
+    if to_remove:
+        invalidate(to_remove)
+
+
+def invalidating(run_fn):
+    """Wrap a run function so commands invalidate the facts they could change.
+    """
+    def _run(command, *args, **kwargs):
+        try:
+            return run_fn(command, *args, **kwargs)
+        finally:
+            invalidate_for_command(command)
+    return _run
+
+# ## Standard facts
+
+
+def home_dir():
+    return get_fact("home", lambda: env.safe_run_output("echo $HOME").strip())
+
+
+def tmp_dir():
+    """Remote $TMPDIR, or None if it is not defined.
+    """
+    def _retrieve():
+        with settings(hide('everything'), warn_only=True):
+            tmp_dir = env.safe_run_output("echo $TMPDIR")
+        if tmp_dir.failed or not tmp_dir.strip():
+            return None
+        return tmp_dir.strip()
+    return get_fact("tmpdir", _retrieve)
+
+
+def machine():
+    return get_fact("machine", lambda: env.safe_run_output("uname -m").strip())
+
+
+def executables_on_path(pnames):
+    """Dictionary of program names to presence on the PATH, probing only unknown programs.
+    """
+    known = get_fact("executables", dict)
+    to_check = [p for p in pnames if p not in known]
+    if to_check:
+        known.update(zip(to_check, env.safe_probe([("executable", p) for p in to_check])))
+    return dict((p, known[p]) for p in pnames)
+
+
+def cores():
+    """Number of processors available on the host.
+    """
+    def _retrieve():
+        with settings(hide('everything'), warn_only=True):
+            out = env.safe_run_output("getconf _NPROCESSORS_ONLN || nproc")
+        try:
+            return max(int(out.strip().split()[-1]), 1)
+        except (ValueError, IndexError):
+            return 1
+    return get_fact("cores", _retrieve)
+
+
+def memory_gb():
+    """Total memory on the host in gigabytes, or None if it could not be determined.
+    """
+    def _retrieve():
+        with settings(hide('everything'), warn_only=True):
+            out = env.safe_run_output("grep MemTotal /proc/meminfo")
+        try:
+            return float(out.split()[1]) / (1024 * 1024)
+        except (ValueError, IndexError):
+            return None
+    return get_fact("memory", _retrieve)
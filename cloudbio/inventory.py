@@ -0,0 +1,141 @@
+"""Query software already installed on a target, with one call per package manager.
+
+Queries return dictionaries of installed names to versions. Comparing these
+against the configured lists with `to_install` leaves only missing or
+outdated items, so re-provisioning a mostly built machine installs little.
+A failed query returns an empty inventory, falling back to installing
+everything.
+"""
+import re
+
+from fabric.api import env
+
+from cloudbio.fabutils import quiet
+
+
+def _query(cmd):
+    with quiet():
+        out = env.safe_run_output(cmd)
+    if out.failed:
+        return []
+    return [l.rstrip("\r") for l in out.split("\n") if l.strip()]
+
+
+def _split_pairs(lines, sep=None):
+    pairs = {}
+    for line in lines:
+        parts = line.split(sep)
+        if len(parts) >= 2:
+            pairs[parts[0].strip()] = parts[1].strip()
+    return pairs
+
+
+def deb_packages():
+    return _split_pairs(l for l in _query("dpkg-query -W -f='${Package}\\t${Version}\\t${Status}\\n'")
+                        if l.endswith("install ok installed"))
+
+
+def deb_upgradable():
+    """Installed debian packages with a newer version available.
+    """
+    return set([l.split()[1] for l in _query("apt-get -s -qq dist-upgrade")
+                if l.startswith("Inst ")])
+
+
+def rpm_packages():
+    return _split_pairs(_query("rpm -qa --qf '%{NAME}\\t%{VERSION}-%{RELEASE}\\n'"))
+
+
+def rpm_upgradable():
+    """Installed rpm packages with a newer version available.
+    """
+    names = set([])
+    for line in _query("yum -q check-update"):
+        parts = line.split()
+        if len(parts) == 3 and "." in parts[0]:
+            names.add(parts[0].rsplit(".", 1)[0])
+    return names
+
+
+def gems(gem_cmd="gem"):
+    """Installed gems, with the newest installed version of each.
+    """
+    out = {}
+    for line in _query("%s list --local" % gem_cmd):
+        match = re.match(r"^(\S+) \(([^,)]+)", line)
+        if match:
+            out[match.group(1)] = match.group(2).replace("default: ", "")
+    return out
+
+
+def gems_outdated(gem_cmd="gem"):
+    """Installed gems with newer releases, in one query against the gem sources.
+    """
+    return set([l.split()[0] for l in _query("%s outdated" % gem_cmd)
+                if re.match(r"^\S+ \(.* < .*\)$", l)])
+
+
+def conda_packages(conda_cmd="conda"):
+    return _split_pairs(l for l in _query("%s list" % conda_cmd) if not l.startswith("#"))
+
+
+def normalize_python(name):
+    return name.lower().replace("_", "-")
+
+
+def python_packages(pip_cmd="pip"):
+    return dict((normalize_python(k), v) for k, v in
+                _split_pairs(_query("%s freeze" % pip_cmd), "==").items())
+
+
+def python_outdated(pip_cmd="pip"):
+    """Installed python packages with newer releases, in one query against the index.
+    """
+    names = set([])
+    for line in _query("%s list --outdated" % pip_cmd):
+        name = line.split()[0]
+        if name not in ["Package"] and not name.startswith("-"):
+            names.add(normalize_python(name))
+    return names
+
+
+def r_packages(rscript="Rscript"):
+    script = ('ip <- installed.packages()[, c("Package", "Version"), drop=FALSE]; '
+              'write.table(ip, quote=FALSE, row.names=FALSE, col.names=FALSE, sep="\\t")')
+    return _split_pairs(_query("%s -e '%s'" % (rscript, script)), "\t")
+
+
+def perl_modules(modules):
+    """Perl modules present in the include path, out of `modules`.
+
+    Checks for module files without loading them; names which are not
+    modules, like bundles, are never found.
+    """
+    if not modules:
+        return {}
+    script = ('for my $m (@ARGV) { (my $f = "$m.pm") =~ s{::}{/}g; '
+              'for (@INC) { if (-f "$_/$f") { print "$m\\n"; last } } }')
+    found = _query("perl -e '%s' %s" % (script, " ".join(modules)))
+    return dict((m, None) for m in found)
+
+
+def to_install(desired, installed, outdated=None, normalize=None):
+    """Items from `desired` which are missing from `installed` or `outdated`.
+
+    Items pinned with name==version must match the installed version.
+    Anything not a plain name, such as a URL, is always installed.
+    """
+    outdated = outdated or set([])
+    normalize = normalize or (lambda x: x)
+    out = []
+    for item in desired:
+        if "/" in item or (":" in item and "::" not in item):
+            out.append(item)
+            continue
+        name, _, version = item.partition("==")
+        name = normalize(re.split(r"[<>=!\[\s]", name.strip())[0])
+        if name not in installed or name in outdated:
+            out.append(item)
+        elif version and installed[name] != version.strip():
+            out.append(item)
+    return out
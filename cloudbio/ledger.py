@@ -0,0 +1,104 @@
+"""Record of completed install steps kept on each target.
+
+Each successful step (native package groups, a custom program, a language
+library group) is appended to a ledger file on the target with a version
+string: a hash of the configuration it installed from or of the installer
+function. Later runs read the ledger once and skip steps whose version is
+unchanged, so resuming a failed run does not probe every program again.
+
+The ledger is a file of JSON lines, one per completed step, where the last
+entry for a step wins. Appending single lines keeps it safe for concurrent
+builds on the same target.
+
+Configuration, in fabricrc.txt:
+
+  - install_ledger -- Ledger file on the target; defaults to
+    cbl_install_ledger.json in local_install. Set to False to disable.
+  - install_ledger_reverify -- Run all steps again, recording them afresh.
+"""
+import hashlib
+import json
+import os
+import time
+
+from fabric.api import env, settings, hide
+
+from cloudbio import artifacts, hostfacts
+
+
+def _ledger_file():
+    setting = env.get("install_ledger", None)
+    if str(setting).lower() in ["false", "no"]:
+        return None
+    if setting:
+        return setting
+    if not env.get("local_install"):
+        return None
+    return os.path.join(env.local_install, "cbl_install_ledger.json")
+
+
+def _reverify():
+    return str(env.get("install_ledger_reverify", "false")).lower() in ["true", "yes"]
+
+
+def _entries():
+    """Retrieve completed steps on the current host, reading the ledger once per run.
+    """
+    def _retrieve():
+        entries = {}
+        with settings(hide('everything'), warn_only=True):
+            out = env.safe_run_output("cat %s 2>/dev/null" % _ledger_file())
+        for line in out.split("\n"):
+            line = line.strip()
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry["step"]] = entry
+        return entries
+    return hostfacts.get_fact("ledger", _retrieve)
+
+
+def version_hash(*parts):
+    """Version string for a step from configuration values and functions.
+
+    Functions contribute a fingerprint of their code, so edits to an installer
+    cause it to run again.
+    """
+    hasher = hashlib.sha1()
+    for part in parts:
+        if callable(part):
+            hasher.update(artifacts.fingerprint(part))
+        else:
+            hasher.update(json.dumps(part, sort_keys=True, default=str))
+    return hasher.hexdigest()
+
+
+def is_done(step, version):
+    """Check if a step completed previously with the same version.
+
+    Steps without a version, like those with no resolvable installer, are
+    never done.
+    """
+    if version is None or _ledger_file() is None or _reverify():
+        return False
+    entry = _entries().get(step)
+    return entry is not None and entry.get("version") == version
+
+
+def record(step, version):
+    """Append a completed step to the ledger on the target, if it has a version.
+    """
+    ledger_file = _ledger_file()
+    if ledger_file is None or version is None:
+        return
+    entry = {"step": step, "version": version, "time": time.time()}
+    _entries()[step] = entry
+    line = json.dumps(entry).replace("'", "\\u0027")
+    with settings(hide('everything'), warn_only=True):
+        result = env.safe_run("mkdir -p %s && echo '%s' >> %s"
+                              % (os.path.dirname(ledger_file), line, ledger_file))
+    if result.failed:
+        env.logger.warn("Could not record %s in install ledger %s" % (step, ledger_file))
+
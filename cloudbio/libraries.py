@@ -1,54 +1,387 @@
 """Installers for programming language specific libraries.
 """
+import hashlib
+import os
+import tarfile
+import tempfile
+from contextlib import contextmanager
 
-from fabric.api import env
+from fabric.api import env, settings, hide, cd
+
+from cloudbio import cache, hostfacts, inventory
+from cloudbio.custom import shared
+
+
+def _r_install_jobs():
+    jobs = env.get("r_install_jobs", "auto")
+    if str(jobs).lower() == "auto":
+        return hostfacts.cores()
+    return max(1, int(jobs))
+
+
+def _offline():
+    return str(env.get("download_cache_offline", "false")).lower() in ["true", "yes"]
+
+
+def _r_binary_repo_dir():
+    """Local directory of R binary packages built for the target's R and platform.
+    """
+    base_dir = env.get("r_binary_repo_dir", None)
+    if not base_dir:
+        return None
+    with settings(hide('everything'), warn_only=True):
+        r_version = env.safe_run_output("R --version").split("\n")[0].strip()
+    key = hashlib.sha1("\0".join([r_version, env.get("distribution", ""), env.get("dist_name", ""),
+                                  hostfacts.machine()])).hexdigest()
+    return os.path.join(os.path.abspath(os.path.expanduser(base_dir)), key[:12])
+
+
+def _repo_packages(repo_dir):
+    """Package names present in the PACKAGES index of a local CRAN-like repository.
+    """
+    pnames = set([])
+    index = os.path.join(repo_dir, "src", "contrib", "PACKAGES")
+    if os.path.exists(index):
+        with open(index) as in_handle:
+            for line in in_handle:
+                if line.startswith("Package:"):
+                    pnames.add(line.split(":", 1)[1].strip())
+    return pnames
+
+
+@contextmanager
+def _r_binary_repo(pkgs):
+    """Provide the local binary repository on the target, collecting new builds afterwards.
+
+    Yields the repository directory on the target, or None if not configured.
+    When packages are missing from the repository, installs on other hosts
+    wait so the packages are built once.
+    """
+    repo_dir = _r_binary_repo_dir()
+    if repo_dir is None:
+        yield None
+        return
+    with shared._make_tmp_dir() as work_dir:
+        remote_dir = os.path.join(work_dir, "cbl_r_repo")
+        if set(pkgs) - _repo_packages(repo_dir) and not _offline():
+            with cache.locked("%s.lock" % repo_dir):
+                # packages may have been built by another host while waiting
+                build = bool(set(pkgs) - _repo_packages(repo_dir))
+                _put_dir(repo_dir, remote_dir)
+                env.safe_run("mkdir -p %s/src/contrib" % remote_dir)
+                yield remote_dir
+                if build:
+                    _get_dir(remote_dir, repo_dir)
+                    env.logger.info("Updated R binary repository %s: %s packages"
+                                    % (repo_dir, len(_repo_packages(repo_dir))))
+        else:
+            _put_dir(repo_dir, remote_dir)
+            env.safe_run("mkdir -p %s/src/contrib" % remote_dir)
+            yield remote_dir
+        env.safe_sudo("rm -rf %s %s.tar.gz" % (remote_dir, remote_dir))
+
+
+def _put_dir(local_dir, remote_dir):
+    """Copy a directory on the machine running fabric to the target, replacing remote_dir.
+    """
+    env.safe_sudo("rm -rf %s" % remote_dir)
+    env.safe_run("mkdir -p %s" % remote_dir)
+    if not os.path.exists(local_dir):
+        return
+    fd, local_file = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(fd)
+    try:
+        with tarfile.open(local_file, "w:gz") as tar_handle:
+            tar_handle.add(local_dir, arcname=".")
+        env.safe_put(local_file, "%s.tar.gz" % remote_dir)
+        env.safe_run("tar -C %s -xzf %s.tar.gz" % (remote_dir, remote_dir))
+    finally:
+        os.remove(local_file)
+
+
+def _get_dir(remote_dir, local_dir):
+    """Copy files from a directory on the target into a directory on the machine running fabric.
+    """
+    env.safe_run("tar -C %s -czf %s.tar.gz ." % (remote_dir, remote_dir))
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    fd, local_file = tempfile.mkstemp(suffix=".tar.gz", dir=os.path.dirname(local_dir))
+    os.close(fd)
+    try:
+        env.safe_get("%s.tar.gz" % remote_dir, local_file)
+        with tarfile.open(local_file, "r:gz") as tar_handle:
+            tar_handle.extractall(local_dir)
+    finally:
+        os.remove(local_file)
 
 
 def r_library_installer(config):
     """Install R libraries using CRAN and Bioconductor.
     """
+    # Only install packages not already present; outdated packages are updated after
+    installed = inventory.r_packages()
+    cran_pkgs = inventory.to_install(config.get("cran", []), installed)
+    bioc_pkgs = inventory.to_install(config.get("bioc", []), installed)
+    if not cran_pkgs and not bioc_pkgs and not config.get("update_packages", True):
+        env.logger.info("All R packages installed")
+        return
+    with _r_binary_repo(cran_pkgs + bioc_pkgs) as repo_dir:
+        _r_install(config, cran_pkgs, bioc_pkgs, repo_dir)
+
+
+def _r_install(config, cran_pkgs, bioc_pkgs, repo_dir):
+    offline = _offline() and repo_dir is not None
     # Create an Rscript file with install details.
     out_file = "install_packages.R"
     if env.safe_exists(out_file):
         env.safe_run("rm -f %s" % out_file)
     env.safe_run("touch %s" % out_file)
     repo_info = """
+    options(Ncpus=%s)
     cran.repos <- getOption("repos")
     cran.repos["CRAN" ] <- "%s"
     options(repos=cran.repos)
+    """ % (_r_install_jobs(), config["cranrepo"])
+    if not offline:
+        repo_info += """
     source("%s")
-    """ % (config["cranrepo"], config["biocrepo"])
+    """ % config["biocrepo"]
     env.safe_append(out_file, repo_info)
-    install_fn = """
-    repo.installer <- function(repos, install.fn) {
-      update.or.install <- function(pname) {
-        if (pname %in% installed.packages())
-          update.packages(lib.loc=c(pname), repos=repos, ask=FALSE)
-        else
-          install.fn(pname)
-      }
-    }
-    """
-    env.safe_append(out_file, install_fn)
-    std_install = """
+    pkg_info = """
     std.pkgs <- c(%s)
-    std.installer = repo.installer(cran.repos, install.packages)
-    lapply(std.pkgs, std.installer)
-    """ % (", ".join('"%s"' % p for p in config['cran']))
-    env.safe_append(out_file, std_install)
-    if len(config.get("bioc", [])) > 0:
-        bioc_install = """
-        bioc.pkgs <- c(%s)
-        bioc.installer = repo.installer(biocinstallRepos(), biocLite)
-        lapply(bioc.pkgs, bioc.installer)
-        """ % (", ".join('"%s"' % p for p in config['bioc']))
-        env.safe_append(out_file, bioc_install)
-    if config.get("update_packages", True):
-        final_update = """
-        update.packages(repos=biocinstallRepos(), ask=FALSE)
-        update.packages(ask=FALSE)
+    bioc.pkgs <- c(%s)
+    build.opts <- character(0)
+    """ % (", ".join('"%s"' % p for p in cran_pkgs), ", ".join('"%s"' % p for p in bioc_pkgs))
+    env.safe_append(out_file, pkg_info)
+    if repo_dir:
+        # Install prebuilt binaries available in the local repository, then
+        # build everything else with --build so binaries are added to it
+        local_install = """
+        local.repo <- "file://%s"
+        local.pkgs <- rownames(available.packages(contriburl=contrib.url(local.repo, "source")))
+        prebuilt <- intersect(c(std.pkgs, bioc.pkgs), local.pkgs)
+        if (length(prebuilt) > 0)
+          install.packages(prebuilt, repos=local.repo, type="source")
+        std.pkgs <- setdiff(std.pkgs, rownames(installed.packages()))
+        bioc.pkgs <- setdiff(bioc.pkgs, rownames(installed.packages()))
+        setwd("%s/src/contrib")
+        build.opts <- "--build"
+        # parallel installs build in temporary directories, leaving binaries there
+        options(Ncpus=1)
+        """ % (repo_dir, repo_dir)
+        env.safe_append(out_file, local_install)
+    if offline:
+        env.logger.info("Offline mode: installing R packages from local repository only")
+    else:
+        remote_install = """
+        if (length(std.pkgs) > 0)
+          install.packages(std.pkgs, INSTALL_opts=build.opts)
+        if (length(bioc.pkgs) > 0)
+          biocLite(bioc.pkgs, INSTALL_opts=build.opts)
+        """
+        env.safe_append(out_file, remote_install)
+    if repo_dir and not offline:
+        # Binary builds are named like pkg_1.0_R_x86_64-pc-linux-gnu.tar.gz;
+        # install.packages expects pkg_1.0.tar.gz
+        index_repo = """
+        for (fname in list.files(pattern="_R_"))
+          file.rename(fname, paste(strsplit(fname, "_R_")[[1]][1], ".tar.gz", sep=""))
+        built <- sub("_.*", "", list.files(pattern="[.]tar[.]gz$"))
+        not.built <- setdiff(intersect(c(std.pkgs, bioc.pkgs), rownames(installed.packages())), built)
+        if (length(not.built) > 0)
+          warning("No binary package built for: ", paste(not.built, collapse=" "))
+        tools::write_PACKAGES(".", type="source")
         """
+        env.safe_append(out_file, index_repo)
+    if config.get("update_packages", True) and not offline:
+        # Only update configured packages with newer versions available
+        final_update = """
+        cfg.pkgs <- c(%s)
+        old.bioc <- intersect(rownames(old.packages(repos=biocinstallRepos())), cfg.pkgs)
+        if (length(old.bioc) > 0)
+          update.packages(repos=biocinstallRepos(), oldPkgs=old.bioc, ask=FALSE)
+        old.cran <- intersect(rownames(old.packages()), cfg.pkgs)
+        if (length(old.cran) > 0)
+          update.packages(oldPkgs=old.cran, ask=FALSE)
+        """ % ", ".join('"%s"' % p for p in config.get("cran", []) + config.get("bioc", []))
         env.safe_append(out_file, final_update)
     # run the script and then get rid of it
     env.safe_sudo("Rscript %s" % out_file)
     env.safe_run("rm -f %s" % out_file)
+
+
+@contextmanager
+def _gem_cache(gem_cmd):
+    """Seed the target's gem cache from a shared directory, collecting new gems afterwards.
+    """
+    cache_dir = env.get("ruby_gem_cache", None)
+    if not cache_dir:
+        yield None
+        return
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    with settings(hide('everything'), warn_only=True):
+        gem_dir = env.safe_run_output("%s env gemdir" % gem_cmd).strip()
+    with shared._make_tmp_dir() as work_dir:
+        remote_dir = os.path.join(work_dir, "cbl_gem_cache")
+        _put_dir(cache_dir, remote_dir)
+        with settings(hide('everything'), warn_only=True):
+            env.safe_sudo("mkdir -p %s/cache && cp -n %s/*.gem %s/cache/" % (gem_dir, remote_dir, gem_dir))
+        yield remote_dir
+        with settings(hide('everything'), warn_only=True):
+            env.safe_run("cp -n %s/cache/*.gem %s/" % (gem_dir, remote_dir))
+        _get_dir(remote_dir, cache_dir)
+        env.safe_sudo("rm -rf %s %s.tar.gz" % (remote_dir, remote_dir))
+
+
+def ruby_library_installer(config):
+    """Install ruby specific gems.
+
+    Missing gems are installed in a single transaction and only gems reported
+    by `gem outdated` are updated.
+    """
+    gem_cmd = "gem%s" % getattr(env, "ruby_version_ext", "")
+    installed = inventory.gems(gem_cmd)
+    gems = list(env.flavor.rewrite_config_items("ruby", config['gems']))
+    to_install = inventory.to_install(gems, installed)
+    with _gem_cache(gem_cmd) as gem_cache:
+        if gem_cache and _offline():
+            # Install only from the shared gem files, without contacting gem sources
+            if to_install:
+                with cd(gem_cache):
+                    env.safe_sudo("%s install --local %s" % (gem_cmd, " ".join(to_install)))
+            return
+        outdated = inventory.gems_outdated(gem_cmd) if installed else set([])
+        to_update = [g for g in gems if g in installed and g in outdated]
+        if to_update:
+            env.safe_sudo("%s update %s" % (gem_cmd, " ".join(to_update)))
+        if to_install:
+            env.safe_sudo("%s install %s" % (gem_cmd, " ".join(to_install)))
+
+
+CPANM_URL = "https://raw.github.com/miyagawa/cpanminus/master/cpanm"
+CPAN_URL = "http://www.cpan.org"
+
+
+def _install_cpanm():
+    """Install the cpanm script unless present, using the download cache.
+    """
+    if hostfacts.executables_on_path(["cpanm"])["cpanm"]:
+        return
+    with shared._make_tmp_dir() as tmp_dir:
+        with cd(tmp_dir):
+            cache.fetch(CPANM_URL, "cpanm")
+            env.safe_run("chmod a+rwx cpanm")
+            env.safe_sudo("mv cpanm %s/bin" % env.system_install)
+    hostfacts.invalidate(["executables"])
+
+
+def _perl_install_workers():
+    workers = env.get("perl_install_workers", "auto")
+    if str(workers).lower() == "auto":
+        return min(hostfacts.cores(), 4)
+    return max(1, int(workers))
+
+
+@contextmanager
+def _cpan_mirror():
+    """Provide cpanm options for the configured CPAN mirror.
+
+    A URL is used as the only mirror. A directory on the machine running
+    fabric is copied to the target: a minicpan mirror, with a package index,
+    is used as the only mirror, otherwise the directory collects downloaded
+    distributions to use before CPAN on later hosts.
+    """
+    mirror = env.get("perl_cpan_mirror", None)
+    if not mirror:
+        yield ""
+    elif "://" in mirror:
+        yield "--mirror %s --mirror-only" % mirror
+    else:
+        mirror = os.path.abspath(os.path.expanduser(mirror))
+        with shared._make_tmp_dir() as work_dir:
+            remote_dir = os.path.join(work_dir, "cbl_cpan_mirror")
+            _put_dir(mirror, remote_dir)
+            if os.path.exists(os.path.join(mirror, "modules", "02packages.details.txt.gz")):
+                yield "--mirror file://%s --mirror-only" % remote_dir
+            else:
+                yield "--mirror file://%s --mirror %s --save-dists %s" % (remote_dir, CPAN_URL,
+                                                                         remote_dir)
+                _get_dir(remote_dir, mirror)
+            env.safe_sudo("rm -rf %s %s.tar.gz" % (remote_dir, remote_dir))
+
+
+def _perl_dependencies(cpanm, modules):
+    """Retrieve the distribution and direct dependencies of each module.
+
+    Returns a dictionary of module to (distribution, dependencies), leaving
+    out modules cpanm can not resolve.
+    """
+    script = ('for m in %s; do echo "## $m $(%s --info $m 2>/dev/null | tail -n 1)"; '
+              '%s --showdeps $m 2>/dev/null < /dev/null; done' % (" ".join(modules), cpanm, cpanm))
+    with settings(hide('everything'), warn_only=True):
+        out = env.safe_run_output(script)
+    deps = {}
+    cur = None
+    for line in out.split("\n"):
+        parts = line.strip().split()
+        if parts and parts[0] == "##":
+            cur = parts[1] if len(parts) == 3 else None
+            if cur:
+                deps[cur] = (parts[2], set([]))
+        elif parts and cur:
+            name = parts[0].split("~")[0]
+            if name != "perl":
+                deps[cur][1].add(name)
+    return deps
+
+
+def _perl_parallel_install(cpanm, to_install, workers):
+    """Install shared dependencies serially, then independent modules in parallel.
+
+    Direct dependencies of all modules are installed first by a single cpanm
+    call, which also installs their own dependencies in order. Modules with
+    every dependency present then only build their own distribution, so
+    parallel cpanm processes do not install the same distributions at the
+    same time. Modules from the same distribution share a process.
+    """
+    deps = _perl_dependencies(cpanm, to_install)
+    shared_deps = sorted(set([]).union(*[d for _, d in deps.values()]))
+    if shared_deps:
+        with settings(warn_only=True):
+            env.safe_run("%s %s < /dev/null" % (cpanm, " ".join(shared_deps)))
+    present = inventory.perl_modules(shared_deps)
+    by_dist = {}
+    for lib in to_install:
+        if lib in deps and lib not in present and all(x in present for x in deps[lib][1]):
+            by_dist.setdefault(deps[lib][0], []).append(lib)
+    if by_dist:
+        with settings(warn_only=True):
+            env.safe_run("printf '%%s\\n' %s | xargs -L 1 -P %s %s"
+                         % (" ".join("'%s'" % " ".join(x) for x in by_dist.values()),
+                            workers, cpanm))
+
+
+def perl_library_installer(config):
+    """Install perl libraries from CPAN with cpanminus.
+
+    With more than one worker, dependencies are resolved first so that only
+    independent modules install in parallel, followed by a serial pass over
+    modules still missing.
+    """
+    _install_cpanm()
+    sudo_str = "--sudo" if env.use_sudo else ""
+    libs = list(env.flavor.rewrite_config_items("perl", config['cpan']))
+    to_install = inventory.to_install(libs, inventory.perl_modules(libs))
+    if not to_install:
+        return
+    with _cpan_mirror() as mirror_str:
+        # Need to hack stdin because of some problem with cpanminus script that
+        # causes fabric to hang
+        # http://agiletesting.blogspot.com/2010/03/getting-past-hung-remote-processes-in.html
+        cpanm = "cpanm %s --skip-installed --notest %s" % (sudo_str, mirror_str)
+        workers = _perl_install_workers()
+        if workers > 1 and len(to_install) > 1:
+            _perl_parallel_install(cpanm, to_install, workers)
+            to_install = inventory.to_install(to_install, inventory.perl_modules(to_install))
+        for lib in to_install:
+            env.safe_run("%s %s < /dev/null" % (cpanm, lib))
@@ -4,11 +4,15 @@ import os
 
 from fabric.api import env, cd
 
+from cloudbio import hostfacts, ledger, planner
 from cloudbio.custom.shared import _make_tmp_dir
+from cloudbio.flavor.config import get_config_file
+from cloudbio.package.shared import _yaml_to_packages
 from cloudbio.package.deb import (_apt_packages, _add_apt_gpg_keys,
                                   _setup_apt_automation, _setup_apt_sources)
 from cloudbio.package.rpm import (_yum_packages, _setup_yum_bashrc,
                                   _setup_yum_sources)
+from cloudbio.package.proxy import _package_proxy
 
 
 def _configure_and_install_native_packages(env, pkg_install):
@@ -16,23 +20,50 @@ def _configure_and_install_native_packages(env, pkg_install):
     Setups up native package repositories, determines list
     of native packages to install, and installs them.
     """
-    home_dir = env.safe_run("echo $HOME")
+    home_dir = hostfacts.home_dir()
     if home_dir:
         if env.shell_config.startswith("~"):
             nonhome = env.shell_config.split("~/", 1)[-1]
             env.shell_config = os.path.join(home_dir, nonhome)
+    version = _native_packages_version(pkg_install)
+    if ledger.is_done("packages", version):
+        env.logger.info("Skipping native packages; completed previously (install ledger)")
+        return
+    with planner.timed("packages"), _package_proxy():
+        if env.distribution in ["debian", "ubuntu"]:
+            _setup_apt_sources()
+            _setup_apt_automation()
+            _add_apt_gpg_keys()
+            _apt_packages(pkg_install)
+        elif env.distribution in ["centos", "scientificlinux"]:
+            _setup_yum_sources()
+            _yum_packages(pkg_install)
+            if env.edition.short_name not in ["minimal"]:
+                _setup_yum_bashrc()
+        else:
+            raise NotImplementedError("Unknown target distribution")
+    ledger.record("packages", version)
+
+def _native_package_list(env, pkg_install):
+    """Resolve the native packages installed for the configured groups.
+    """
     if env.distribution in ["debian", "ubuntu"]:
-        _setup_apt_sources()
-        _setup_apt_automation()
-        _add_apt_gpg_keys()
-        _apt_packages(pkg_install)
-    elif env.distribution in ["centos", "scientificlinux"]:
-        _setup_yum_sources()
-        _yum_packages(pkg_install)
-        if env.edition.short_name not in ["minimal"]:
-            _setup_yum_bashrc()
+        config_file = get_config_file(env, "packages.yaml")
+        (packages, _) = _yaml_to_packages(config_file.base, pkg_install, config_file.dist)
+        packages = env.edition.rewrite_config_items("packages", packages)
+    elif env.distribution == "scientificlinux":
+        (packages, _) = _yaml_to_packages(get_config_file(env, "packages-scientificlinux.yaml").base,
+                                          pkg_install)
     else:
-        raise NotImplementedError("Unknown target distribution")
+        (packages, _) = _yaml_to_packages(get_config_file(env, "packages-yum.yaml").base,
+                                          pkg_install)
+    return list(env.flavor.rewrite_config_items("packages", packages))
+
+def _native_packages_version(pkg_install):
+    """Ledger version for native packages, from the list after edition and flavor rewrites.
+    """
+    return ledger.version_hash(env.distribution, env.get("dist_name", ""),
+                               sorted(_native_package_list(env, pkg_install)))
 
 def _connect_native_packages(env, pkg_install, lib_install):
     """Connect native installed packages to local versions.
@@ -1,9 +1,15 @@
 """
 Automated installation on debian package systems with apt.
 """
+import os
+import tempfile
+
 from fabric.api import *
 from fabric.contrib.files import *
 
+from cloudbio import hostfacts, inventory, trace
+from cloudbio.fabutils import quiet
+from cloudbio.package import proxy
 from cloudbio.package.shared import _yaml_to_packages
 from cloudbio.flavor.config import get_config_file
 
@@ -38,17 +44,208 @@ def _apt_packages(to_install=None, pkg_list=None):
         packages = pkg_list
     else:
         raise ValueError("Need a file with packages or a list of packages")
-    # A single line install is much faster - note that there is a max
-    # for the command line size, so we do 30 at a time
-    group_size = 30
-    i = 0
-    env.logger.info("Installing %i packages" % len(packages))
-    while i < len(packages):
-        env.logger.info("Package install progress: {0}/{1}".format(i, len(packages)))
-        env.safe_sudo("apt-get -y --force-yes install %s" % " ".join(packages[i:i + group_size]))
-        i += group_size
+    _apt_install(list(packages))
     env.safe_sudo("apt-get clean")
 
+# ## Apt install engine
+
+APT_ARCHIVES = "/var/cache/apt/archives"
+APT_INSTALL = "apt-get -y --force-yes install"
+# Keep individual remote commands well below the kernel limit on argument size
+APT_QUERY_SIZE = 400
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _apt_install(packages):
+    """Install packages with parallel downloads and a single dpkg transaction.
+
+    Resolves all packages at once and downloads the needed .deb files into the
+    apt archive cache with `apt_download_workers` concurrent connections, then
+    installs everything with one apt-get call. Virtual packages are replaced
+    by a provider. If that fails, packages that did not get installed are
+    retried one at a time so a single broken package does not hold back the
+    rest.
+    """
+    packages = _unique(packages)
+    installed = inventory.deb_packages()
+    packages = inventory.to_install(packages, installed, inventory.deb_upgradable())
+    if not packages:
+        env.logger.info("All packages installed and up to date")
+        return
+    available = _apt_available(packages)
+    unknown = [p for p in packages if p not in available]
+    if unknown:
+        providers = _apt_virtual_providers(unknown, installed)
+        packages = _unique([providers.get(p, p) for p in packages
+                            if not (p in providers and providers[p] in installed)])
+        unknown = [p for p in unknown if p not in providers]
+        available.update(p for p in packages if p not in unknown)
+    if not packages:
+        env.logger.info("All packages installed and up to date")
+        return
+    env.logger.info("Installing %i missing or outdated packages" % len(packages))
+    if unknown:
+        env.logger.warn("No install candidate found for: %s" % " ".join(unknown))
+    to_install = [p for p in packages if p in available]
+    with trace.span("apt prefetch", "download", packages=len(to_install)):
+        _apt_prefetch(to_install)
+    with trace.span("apt-get install", "package", packages=to_install):
+        with settings(warn_only=True):
+            result = env.safe_sudo("%s %s" % (APT_INSTALL, " ".join(to_install))) if to_install else None
+    if result is None or result.failed or unknown:
+        _apt_retry_missing(packages)
+
+
+def _unique(items):
+    seen = set([])
+    out = []
+    for x in items:
+        if x not in seen:
+            seen.add(x)
+            out.append(x)
+    return out
+
+
+def _apt_available(packages):
+    """Retrieve the packages with an install candidate in the configured sources.
+    """
+    available = set([])
+    for group in _chunks(packages, APT_QUERY_SIZE):
+        with quiet():
+            out = env.safe_run_output("apt-cache policy %s" % " ".join(group))
+        cur = None
+        for line in out.split("\n"):
+            line = line.rstrip("\r")
+            if line and not line.startswith(" ") and line.endswith(":"):
+                cur = line[:-1]
+            elif cur and line.strip().startswith("Candidate:"):
+                if line.split(":", 1)[1].strip() != "(none)":
+                    available.add(cur)
+                cur = None
+    return available
+
+
+def _apt_virtual_providers(packages, installed):
+    """Map virtual packages to a real package providing them.
+
+    Prefers a provider that is already installed, otherwise takes the first
+    one apt lists.
+    """
+    providers = {}
+    for group in _chunks(packages, APT_QUERY_SIZE):
+        with quiet():
+            out = env.safe_run_output("apt-cache showpkg %s" % " ".join(group))
+        cur = None
+        in_provides = False
+        for line in out.split("\n"):
+            line = line.rstrip("\r")
+            if line.startswith("Package:"):
+                cur = line.split(":", 1)[1].strip()
+                in_provides = False
+            elif line.startswith("Reverse Provides:"):
+                in_provides = True
+            elif in_provides and cur and line.strip():
+                provider = line.split()[0]
+                if cur not in providers or (provider in installed
+                                            and providers[cur] not in installed):
+                    providers[cur] = provider
+    for virtual, provider in providers.items():
+        env.logger.debug("Virtual package %s provided by %s" % (virtual, provider))
+    return providers
+
+
+def _apt_download_uris(packages):
+    """Retrieve (url, filename, size) for .deb files needed to install packages.
+    """
+    uris = []
+    for group in _chunks(packages, APT_QUERY_SIZE):
+        with quiet():
+            out = env.safe_run_output("apt-get install -qq -y --force-yes --print-uris %s"
+                                      % " ".join(group))
+        for line in out.split("\n"):
+            parts = line.strip().split()
+            if len(parts) >= 3 and parts[0].startswith("'") and parts[0].endswith("'"):
+                try:
+                    size = int(parts[2])
+                except ValueError:
+                    size = 0
+                uris.append((parts[0][1:-1], parts[1], size))
+    return _unique(uris)
+
+
+def _apt_prefetch(packages):
+    """Download .deb files for packages into the apt archive cache in parallel.
+
+    Downloads are spread over workers by size using a script run on the
+    target. Failed downloads are left for apt-get to retrieve itself.
+    """
+    uris = _apt_download_uris(packages)
+    if not uris:
+        return
+    workers = max(int(env.get("apt_download_workers", 8)), 1)
+    queues = [[] for _ in range(min(workers, len(uris)))]
+    totals = [0] * len(queues)
+    for url, fname, size in sorted(uris, key=lambda x: x[2], reverse=True):
+        i = totals.index(min(totals))
+        queues[i].append((url, fname))
+        totals[i] += size
+    env.logger.info("Downloading %s packages (%.1f Mb) with %s connections"
+                    % (len(uris), sum(totals) / (1024.0 * 1024.0), len(queues)))
+    lines = ["#!/bin/bash",
+             "cd %s" % APT_ARCHIVES,
+             "export http_proxy=%s" % (proxy.active_proxy() or ""),
+             'fetch() { [ -f "$2" ] || { wget -q -t 3 -O "partial/$2" "$1" && mv "partial/$2" "$2"; }; }']
+    for queue in queues:
+        lines.append("(%s) &" % "; ".join("fetch '%s' '%s'" % (url, fname) for url, fname in queue))
+    lines.append("wait")
+    fd, local_script = tempfile.mkstemp(suffix=".sh")
+    os.close(fd)
+    try:
+        with open(local_script, "w") as out_handle:
+            out_handle.write("\n".join(lines) + "\n")
+        remote_script = os.path.join(hostfacts.tmp_dir() or "/tmp", "cbl_apt_prefetch.sh")
+        env.safe_put(local_script, remote_script)
+    finally:
+        os.remove(local_script)
+    with settings(warn_only=True):
+        env.safe_sudo("bash %s" % remote_script)
+    env.safe_run("rm -f %s" % remote_script)
+
+
+def _apt_installed(packages):
+    """Retrieve the subset of packages that are currently installed.
+    """
+    installed = set([])
+    for group in _chunks(packages, APT_QUERY_SIZE):
+        with quiet():
+            out = env.safe_run_output("COLUMNS=250 dpkg -l %s" % " ".join(group))
+        for line in out.split("\n"):
+            parts = line.split()
+            if len(parts) >= 2 and parts[0] == "ii":
+                installed.add(parts[1].split(":")[0])
+    return installed
+
+
+def _apt_retry_missing(packages):
+    """Repair the dpkg state and retry packages that failed to install, one at a time.
+    """
+    with settings(warn_only=True):
+        env.safe_sudo("dpkg --configure -a")
+        env.safe_sudo("apt-get -y --force-yes -f install")
+    installed = _apt_installed(packages)
+    failed = []
+    for p in [p for p in packages if p not in installed]:
+        with trace.span("apt-get install %s" % p, "package", packages=[p]):
+            with settings(warn_only=True):
+                result = env.safe_sudo("%s %s" % (APT_INSTALL, p))
+        if result.failed:
+            failed.append(p)
+    if failed:
+        raise ValueError("Could not install packages: %s" % " ".join(failed))
+
 def _add_apt_gpg_keys():
     """Adds GPG keys from all repositories
     """
@@ -130,7 +327,7 @@ def _setup_apt_sources():
     # It may be sudo is not installed - which has fab fail - therefor
     # we'll try to install it by default, assuming we have root access
     # already (e.g. on EC2). Fab will fail anyway, otherwise.
-    if not env.safe_exists('/usr/bin/sudo') or not env.safe_exists('/usr/bin/curl'):
+    if not all(env.safe_probe([("exists", "/usr/bin/sudo"), ("exists", "/usr/bin/curl")])):
         env.safe_sudo('apt-get update')
         env.safe_sudo('apt-get -y --force-yes install sudo curl')
 
@@ -152,17 +349,24 @@ def _setup_apt_sources():
         # check there is no error parsing the file
         env.logger.debug(env.safe_sudo("apt-cache policy"))
 
+    sources = env.edition.rewrite_apt_sources_list(env.std_sources)
+    # Check for the source file and all configured sources in a single call
+    checks = [("exists", env.sources_file), ("contains", env.sources_file, comment)]
+    for source in sources:
+        checks.append(("contains", env.sources_file, source))
+        checks.append(("contains", env.global_sources_file, source))
+    present = env.safe_probe(checks)
     # Make sure a source file exists
-    if not env.safe_exists(env.sources_file):
+    if not present[0]:
         env.safe_sudo("touch %s" % env.sources_file)
     # Add a comment
-    if not env.safe_contains(env.sources_file, comment):
+    if not present[1]:
         env.safe_append(env.sources_file, comment, use_sudo=True)
-    for source in env.edition.rewrite_apt_sources_list(env.std_sources):
+    for i, source in enumerate(sources):
         env.logger.debug("Source %s" % source)
+        in_sources, in_global = present[2 + 2 * i], present[3 + 2 * i]
         if source.startswith("ppa:"):
             env.safe_sudo("apt-get install -y --force-yes python-software-properties")
             env.safe_sudo("add-apt-repository '%s'" % source)
-        elif (not env.safe_contains(env.sources_file, source) and
-              not env.safe_contains(env.global_sources_file, source)):
+        elif not in_sources and not in_global:
             env.safe_append(env.sources_file, source, use_sudo=True)
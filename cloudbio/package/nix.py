@@ -3,6 +3,7 @@
 from fabric.api import *
 from fabric.contrib.files import *
 
+from cloudbio import hostfacts
 from cloudbio.package.shared import _yaml_to_packages
 from cloudbio.flavor.config import get_config_file
 
@@ -26,27 +27,61 @@ def _setup_nix_sources():
                    # run("wget http://hydra.nixos.org/build/565031/download/1/nix_0.16-1_i386.deb")
                    run("wget http://hydra.nixos.org/build/565048/download/1/"+nix_deb)
                    sudo("dpkg -i "+nix_deb)
-        run("nix-channel --list")
         if run("nix-channel --list") == "":
             # Setup channel
             sudo("nix-channel --add http://nixos.org/releases/nixpkgs/channels/nixpkgs-unstable")
-        sudo("nix-channel --update")
+            hostfacts.invalidate(["nix_channels"])
+        _setup_nix_binary_cache()
+        _nix_channel_update()
         # upgrade Nix to latest (and remove the older version, as it is much slower)
         sudo("nix-env -b -i nix")
         if exists("/usr/bin/nix-env"):
             env.logger.info("uninstall older Nix (Debian release)")
             sudo("dpkg -r nix")
 
+def _nix_channel_update():
+    """Update nix channels once per run on each host.
+    """
+    def _update():
+        sudo("nix-channel --update")
+        return True
+    hostfacts.get_fact("nix_channels", _update)
+
+def _setup_nix_binary_cache():
+    """Configure binary caches to substitute prebuilt packages, from `nix_binary_cache`.
+
+    `nix_binary_cache` is a space separated list of cache URLs, tried before
+    building from source, and `nix_binary_cache_keys` lists the public keys
+    that sign them.
+    """
+    caches = env.get("nix_binary_cache", None)
+    if not caches:
+        return
+    version = run("nix-env --version").split()[-1]
+    if int(version.split(".")[0]) >= 2:
+        cache_opt, key_opt = "substituters", "trusted-public-keys"
+    else:
+        cache_opt, key_opt = "binary-caches", "binary-cache-public-keys"
+    options = [(cache_opt, "%s https://cache.nixos.org" % caches)]
+    if env.get("nix_binary_cache_keys"):
+        options.append((key_opt, "%s cache.nixos.org-1:6NCHdD59X431o0gWypbMrAURkbJ16ZPMQFGspcDShjY="
+                         % env.nix_binary_cache_keys))
+    sudo("mkdir -p /etc/nix && touch /etc/nix/nix.conf")
+    for name, value in options:
+        sudo("sed -i '/^%s *=/d' /etc/nix/nix.conf" % name)
+        append("/etc/nix/nix.conf", "%s = %s" % (name, value), use_sudo=True)
+
 def _nix_packages(to_install):
     """Install packages available via nixpkgs (optional)
     """
     if env.nixpkgs:
         env.logger.info("Update and install NixPkgs packages")
         pkg_config_file = get_config_file(env, "packages-nix.yaml").base
-        sudo("nix-channel --update")
+        _nix_channel_update()
         # Retrieve final package names
         (packages, _) = _yaml_to_packages(pkg_config_file, to_install)
         packages = env.edition.rewrite_config_items("packages", packages)
         packages = env.flavor.rewrite_config_items("packages", packages)
-        for p in packages:
-            sudo("nix-env -b -i %s" % p)
+        # A single nix-env call evaluates nixpkgs once for all packages
+        if packages:
+            sudo("nix-env -b -i %s" % " ".join(packages))
@@ -0,0 +1,193 @@
+"""Point package managers on targets at a shared caching proxy.
+
+When bringing up many machines, each downloading the same packages from
+upstream mirrors, a caching HTTP proxy close to the targets fetches each
+package once. apt or yum on each target is configured to use the proxy before
+any packages are installed. The proxy can be an existing apt-cacher-ng (or
+any HTTP caching proxy), bootstrapped by installing apt-cacher-ng on one of
+the targets, or a stand-in proxy (utils/cbl_package_proxy.py) started on the
+machine running fabric.
+
+Configuration, in fabricrc.txt:
+
+  - package_proxy -- URL of the proxy, `bootstrap` to install apt-cacher-ng
+    on `package_proxy_host` (the first host by default) or `controller` to run
+    the stand-in proxy on the machine running fabric.
+  - package_proxy_port -- Port for bootstrapped and controller proxies (3142).
+  - package_proxy_cache_dir -- Cache directory for the controller proxy.
+
+The proxy is only configured while native packages install.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from fabric.api import env, settings, hide, run, sudo
+
+from cloudbio import hostfacts
+
+APT_PROXY_FILE = "/etc/apt/apt.conf.d/01cloudbiolinux-proxy"
+YUM_CONF = "/etc/yum.conf"
+YUM_BACKUP = ".cbl-proxy-orig"
+ACNG_CONF = "/etc/apt-cacher-ng/cloudbiolinux.conf"
+PROXY_START_TIMEOUT = 10
+
+_BOOTSTRAPPED = set([])
+
+
+def _port():
+    return int(env.get("package_proxy_port", 3142))
+
+
+def _proxy_host():
+    return env.get("package_proxy_host", None) or env.hosts[0]
+
+
+def prepare():
+    """Start or bootstrap the configured proxy before installing on targets.
+
+    Call once before running installs on many hosts in parallel, so the proxy
+    is set up a single time.
+    """
+    setting = env.get("package_proxy", None)
+    if setting == "bootstrap":
+        bootstrap_proxy(_proxy_host())
+    elif setting == "controller":
+        start_controller_proxy()
+
+
+def proxy_url():
+    """URL of the package proxy as seen from the current host, or None if not configured.
+    """
+    setting = env.get("package_proxy", None)
+    if not setting:
+        return None
+    prepare()
+    if setting == "bootstrap":
+        address = _proxy_host().split("@")[-1].split(":")[0]
+        return "http://%s:%s" % (address, _port())
+    elif setting == "controller":
+        return "http://%s:%s" % (_controller_address(), _port())
+    return setting
+
+
+def active_proxy():
+    """Proxy configured for package downloads on the current host, if any.
+    """
+    return hostfacts.get_fact("package_proxy", lambda: None)
+
+
+def bootstrap_proxy(host):
+    """Install and start apt-cacher-ng on a host, once per run.
+    """
+    if host in _BOOTSTRAPPED:
+        return
+    env.logger.info("Setting up apt-cacher-ng package proxy on %s" % host)
+    with settings(host_string=host):
+        with settings(hide('everything'), warn_only=True):
+            present = run("test -e /usr/sbin/apt-cacher-ng").succeeded
+            has_apt = run("which apt-get").succeeded
+        if not present:
+            if has_apt:
+                sudo("apt-get update")
+                sudo("DEBIAN_FRONTEND=noninteractive apt-get -y install apt-cacher-ng")
+            else:
+                sudo("yum -y install epel-release")
+                sudo("yum -y install apt-cacher-ng")
+        # Cache rpm packages as well as debs, and listen on the configured port
+        sudo("echo 'Port: %s' > %s" % (_port(), ACNG_CONF))
+        sudo("echo 'PfilePatternEx: \\.(rpm|drpm)$' >> %s" % ACNG_CONF)
+        sudo("service apt-cacher-ng restart")
+    _BOOTSTRAPPED.add(host)
+
+
+def _listening(port):
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        conn.connect(("127.0.0.1", port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        conn.close()
+
+
+def start_controller_proxy():
+    """Start the stand-in caching proxy on the machine running fabric if not running.
+    """
+    if _listening(_port()):
+        return
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                          "utils", "cbl_package_proxy.py")
+    cache_dir = env.get("package_proxy_cache_dir", "~/.cloudbiolinux/packages")
+    log_file = os.path.expanduser(os.path.join(cache_dir, "proxy.log"))
+    if not os.path.exists(os.path.dirname(log_file)):
+        os.makedirs(os.path.dirname(log_file))
+    with open(log_file, "a") as log_handle:
+        proc = subprocess.Popen([sys.executable, os.path.normpath(script), "--port", str(_port()),
+                                 "--cache-dir", cache_dir],
+                                stdout=log_handle, stderr=log_handle, close_fds=True)
+    # wait for the proxy to listen before targets check that it is reachable
+    start = time.time()
+    while not _listening(_port()) and proc.poll() is None \
+            and time.time() - start < PROXY_START_TIMEOUT:
+        time.sleep(0.2)
+    if not _listening(_port()):
+        env.logger.warn("Package proxy did not start listening on port %s; see %s"
+                        % (_port(), log_file))
+        return
+    env.logger.info("Started package proxy on port %s (pid %s); log in %s"
+                    % (_port(), proc.pid, log_file))
+
+
+def _controller_address():
+    """Address of the machine running fabric as seen by the current target.
+    """
+    def _retrieve():
+        with settings(hide('everything'), warn_only=True):
+            ssh_client = env.safe_run_output("echo $SSH_CLIENT").strip()
+        return ssh_client.split()[0] if ssh_client else "127.0.0.1"
+    return hostfacts.get_fact("controller_address", _retrieve)
+
+
+@contextmanager
+def _package_proxy():
+    """Configure apt or yum on the target to download through the package proxy.
+
+    The configuration is removed, restoring any previous yum proxy setting,
+    once packages are installed, so images built from the target do not
+    depend on the proxy.
+    """
+    url = proxy_url()
+    if not url:
+        yield
+        return
+    with settings(hide('everything'), warn_only=True):
+        reachable = env.safe_run("! command -v curl >/dev/null || "
+                                 "curl -s -o /dev/null --max-time 5 %s" % url).succeeded
+    if not reachable:
+        env.logger.warn("Package proxy %s is not reachable; downloading from mirrors" % url)
+        yield
+        return
+    env.logger.info("Using package proxy %s" % url)
+    is_apt = env.distribution in ["debian", "ubuntu"]
+    if is_apt:
+        env.safe_sudo("""echo 'Acquire::http::Proxy "%s";' > %s""" % (url, APT_PROXY_FILE))
+        # apt-cacher-ng can not cache https downloads
+        env.safe_sudo("""echo 'Acquire::https::Proxy "DIRECT";' >> %s""" % APT_PROXY_FILE)
+    else:
+        env.safe_sudo("cp -p %s %s%s" % (YUM_CONF, YUM_CONF, YUM_BACKUP))
+        env.safe_sudo("sed -i '/^proxy=/d' %s" % YUM_CONF)
+        env.safe_sudo("sed -i '/^\\[main\\]/a proxy=%s' %s" % (url, YUM_CONF))
+    hostfacts.set_fact("package_proxy", url)
+    try:
+        yield
+    finally:
+        if is_apt:
+            env.safe_sudo("rm -f %s" % APT_PROXY_FILE)
+        else:
+            env.safe_sudo("mv %s%s %s" % (YUM_CONF, YUM_BACKUP, YUM_CONF))
+        hostfacts.set_fact("package_proxy", None)
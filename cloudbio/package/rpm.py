@@ -3,6 +3,8 @@
 from fabric.api import *
 from fabric.contrib.files import *
 
+from cloudbio import inventory, trace
+from cloudbio.fabutils import quiet
 from cloudbio.package.shared import _yaml_to_packages
 from cloudbio.flavor.config import get_config_file
 
@@ -22,8 +24,67 @@ def _yum_packages(to_install):
     (packages, _) = _yaml_to_packages(pkg_config, to_install)
     # At this point allow the Flavor to rewrite the package list
     packages = env.flavor.rewrite_config_items("packages", packages)
-    for package in packages:
-        env.safe_sudo("yum -y install %s" % package)
+    _yum_install(list(packages))
+
+# Keep individual remote commands well below the kernel limit on argument size
+YUM_QUERY_SIZE = 400
+
+
+def _yum_install(packages):
+    """Install packages in a single yum transaction, isolating failures.
+
+    If the transaction fails the package list is bisected, installing each
+    half separately, until the packages which break the install are found.
+    Packages yum has no candidate for are reported separately.
+    """
+    packages = inventory.to_install(packages, inventory.rpm_packages(), inventory.rpm_upgradable())
+    if not packages:
+        env.logger.info("All packages installed and up to date")
+        return
+    env.logger.info("Installing %i missing or outdated packages" % len(packages))
+    failed = _yum_bisect(packages)
+    missing = [p for p in packages if p not in _rpm_installed(packages)]
+    unavailable = [p for p in missing if p not in failed]
+    if unavailable:
+        env.logger.warn("Packages not available from yum repositories: %s" % " ".join(unavailable))
+    if failed:
+        raise ValueError("Could not install packages: %s" % " ".join(failed))
+
+
+def _yum_bisect(packages):
+    """Install a group of packages, splitting it in half on failure.
+
+    Returns the packages which fail to install on their own.
+    """
+    if not packages:
+        return []
+    with trace.span("yum install %s packages" % len(packages), "package", packages=packages):
+        with settings(warn_only=True):
+            result = env.safe_sudo("yum -y install %s" % " ".join(packages))
+    if not result.failed:
+        return []
+    if len(packages) == 1:
+        return packages
+    env.logger.info("yum install of %s packages failed; splitting to isolate failures"
+                    % len(packages))
+    mid = len(packages) // 2
+    return _yum_bisect(packages[:mid]) + _yum_bisect(packages[mid:])
+
+
+def _rpm_installed(packages):
+    """Retrieve the packages, or capabilities, provided by installed rpms.
+    """
+    installed = set([])
+    for i in range(0, len(packages), YUM_QUERY_SIZE):
+        group = packages[i:i + YUM_QUERY_SIZE]
+        with quiet():
+            out = env.safe_run_output("rpm -q --whatprovides %s" % " ".join(group))
+        missing = set([])
+        for line in out.split("\n"):
+            if line.startswith("no package provides"):
+                missing.add(line.split()[-1].strip())
+        installed.update([p for p in group if p not in missing])
+    return installed
 
 def _setup_yum_bashrc():
     """Fix the user bashrc to update compilers.
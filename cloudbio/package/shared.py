@@ -1,28 +1,71 @@
 """Shared functionality useful for multiple package managers.
 """
+import collections
+import copy
+import os
+
 import yaml
 from fabric.api import *
 from fabric.contrib.files import *
 
+# Use the C LibYAML parser when available
+YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+
+_YAML_CACHE = {}
+_PACKAGE_CACHE = {}
+
+def _file_key(fname):
+    fname = os.path.abspath(fname)
+    return (fname, os.path.getmtime(fname))
+
+def _parse_yaml(fname):
+    """Parse a YAML file once per run, re-reading only if it changes.
+    """
+    key = _file_key(fname)
+    if key not in _YAML_CACHE:
+        with open(fname) as in_handle:
+            _YAML_CACHE[key] = yaml.load(in_handle, Loader=YamlLoader)
+    return _YAML_CACHE[key]
+
+def _load_yaml(fname):
+    """Retrieve the contents of a YAML configuration file, parsed once per run.
+
+    Returns a copy so callers can modify the result.
+    """
+    return copy.deepcopy(_parse_yaml(fname))
+
 def _yaml_to_packages(yaml_file, to_install, subs_yaml_file = None):
     """Read a list of packages from a nested YAML configuration file.
+
+    Results are cached by file, modification time and the settings that
+    determine which packages are selected. `to_install` may be a single group name.
     """
+    if isinstance(to_install, basestring):
+        to_install = [to_install]
+    key = (_file_key(yaml_file), to_install if to_install is None else tuple(sorted(to_install)),
+           _file_key(subs_yaml_file) if subs_yaml_file is not None else None,
+           env.get("distribution"), env.get("dist_name"), env.get("is_64bit"))
+    if key not in _PACKAGE_CACHE:
+        _PACKAGE_CACHE[key] = _read_yaml_packages(yaml_file, to_install, subs_yaml_file)
+    packages, pkg_to_group = _PACKAGE_CACHE[key]
+    return list(packages), dict(pkg_to_group)
+
+def _read_yaml_packages(yaml_file, to_install, subs_yaml_file):
     env.logger.info("Reading %s" % yaml_file)
-    with open(yaml_file) as in_handle:
-        full_data = yaml.load(in_handle)
+    full_data = _parse_yaml(yaml_file)
     if subs_yaml_file is not None:
-        with open(subs_yaml_file) as in_handle:
-            subs = yaml.load(in_handle)
+        subs = _parse_yaml(subs_yaml_file)
     else:
         subs = {}
     # filter the data based on what we have configured to install
     data = [(k, v) for (k, v) in full_data.iteritems()
             if to_install is None or k in to_install]
     data.sort()
+    data = collections.deque(data)
     packages = []
     pkg_to_group = dict()
     while len(data) > 0:
-        cur_key, cur_info = data.pop(0)
+        cur_key, cur_info = data.popleft()
         if cur_info:
             if isinstance(cur_info, (list, tuple)):
                 packages.extend(_filter_subs_packages(cur_info, subs))
@@ -33,12 +76,12 @@ def _yaml_to_packages(yaml_file, to_install, subs_yaml_file = None):
                     # if we are okay, propagate with the top level key
                     if key == 'needs_64bit':
                         if env.is_64bit:
-                            data.insert(0, (cur_key, val))
+                            data.appendleft((cur_key, val))
                     elif key.startswith(env.distribution):
                         if key.endswith(env.dist_name):
-                            data.insert(0, (cur_key, val))
+                            data.appendleft((cur_key, val))
                     else:
-                        data.insert(0, (cur_key, val))
+                        data.appendleft((cur_key, val))
             else:
                 raise ValueError(cur_info)
     env.logger.debug("Packages to install: {0}".format(",".join(packages)))
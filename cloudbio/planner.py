@@ -0,0 +1,163 @@
+"""Plan install runs without executing them, with time estimates from earlier runs.
+
+Durations of completed install steps are appended to a history file on the
+machine running fabric. A plan lists the steps a run would take in order,
+annotated with the median of recent durations for each step, along with the
+critical path through the run and the total estimated time. Steps inside a
+phase run in parallel (custom programs) use their declared dependencies and
+the number of workers to estimate elapsed time.
+
+Configuration, in fabricrc.txt:
+
+  - timing_history -- File to keep step durations in; defaults to
+    ~/.cloudbiolinux/timings.json
+"""
+import collections
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from fabric.api import env
+
+HISTORY_RUNS = 5
+
+
+class Step:
+    """An install step with the items it installs and steps it depends on.
+
+    `done` marks steps the install ledger shows as already complete.
+    """
+    def __init__(self, name, phase, items=None, depends=None, done=False):
+        self.name = name
+        self.phase = phase
+        self.items = list(items or [])
+        self.depends = list(depends or [])
+        self.done = done
+
+
+def _history_file():
+    return os.path.expanduser(env.get("timing_history", "~/.cloudbiolinux/timings.json"))
+
+
+def record_timing(step, duration):
+    """Append the duration of a completed step to the timing history.
+    """
+    history_file = _history_file()
+    if not os.path.exists(os.path.dirname(history_file)):
+        os.makedirs(os.path.dirname(history_file))
+    entry = {"step": step, "duration": duration, "time": time.time(),
+             "host": env.get("host_string") or "localhost"}
+    with open(history_file, "a") as out_handle:
+        out_handle.write(json.dumps(entry) + "\n")
+
+
+@contextmanager
+def timed(step):
+    """Record the duration of a block as a step in the timing history, on success.
+    """
+    start = time.time()
+    yield
+    record_timing(step, time.time() - start)
+
+
+def load_timings():
+    """Median duration of the most recent runs of each step in the history.
+    """
+    durations = collections.defaultdict(list)
+    history_file = _history_file()
+    if os.path.exists(history_file):
+        with open(history_file) as in_handle:
+            for line in in_handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                durations[entry["step"]].append(entry["duration"])
+    timings = {}
+    for step, vals in durations.iteritems():
+        recent = sorted(vals[-HISTORY_RUNS:])
+        timings[step] = recent[len(recent) // 2]
+    return timings
+
+
+def estimate(steps, timings, workers=None):
+    """Estimate elapsed time and the critical path for a list of steps.
+
+    Phases run one after another. `workers` maps phases whose steps run
+    concurrently to the number of workers; other phases run steps serially.
+    Returns the total estimated seconds and the critical path as step names.
+    """
+    workers = workers or {}
+    phases = []
+    for step in steps:
+        if step.phase not in phases:
+            phases.append(step.phase)
+    total = 0.0
+    path = []
+    for phase in phases:
+        phase_steps = [s for s in steps if s.phase == phase]
+        est = dict((s.name, 0.0 if s.done else timings.get(s.name, 0.0)) for s in phase_steps)
+        if phase not in workers:
+            total += sum(est.values())
+            path.extend([s.name for s in phase_steps if not s.done])
+            continue
+        # Longest chain of dependencies through the phase
+        by_name = dict((s.name, s) for s in phase_steps)
+        finish, previous, visiting = {}, {}, set([])
+        def _finish(name):
+            if name not in finish:
+                if name in visiting:
+                    raise ValueError("Dependency cycle involving %s" % name)
+                visiting.add(name)
+                deps = [d for d in by_name[name].depends if d in by_name]
+                before = max(deps, key=_finish) if deps else None
+                finish[name] = est[name] + (_finish(before) if before else 0.0)
+                previous[name] = before
+            return finish[name]
+        for s in phase_steps:
+            _finish(s.name)
+        last = max(finish, key=lambda n: finish[n])
+        chain = []
+        while last:
+            chain.insert(0, last)
+            last = previous[last]
+        total += max(finish[chain[-1]], sum(est.values()) / max(workers[phase], 1))
+        path.extend([n for n in chain if est[n] > 0])
+    return total, path
+
+
+def _format_time(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def report(steps, workers=None, output=None):
+    """Log an install plan with estimated durations, optionally writing it as JSON.
+    """
+    timings = load_timings()
+    total, path = estimate(steps, timings, workers)
+    env.logger.info("Install plan: %s steps" % len(steps))
+    for i, step in enumerate(steps):
+        if step.done:
+            status = "skip (install ledger)"
+        else:
+            status = _format_time(timings.get(step.name))
+        env.logger.info("%4d. %-40s %-22s %s items" % (i + 1, step.name, status, len(step.items)))
+    unknown = [s.name for s in steps if not s.done and s.name not in timings]
+    env.logger.info("Critical path: %s" % " -> ".join(path))
+    env.logger.info("Total estimated time: %s%s"
+                    % (_format_time(total),
+                       " (plus %s steps without timing history)" % len(unknown) if unknown else ""))
+    if output:
+        with open(output, "w") as out_handle:
+            json.dump({"steps": [{"name": s.name, "phase": s.phase, "items": s.items,
+                                  "depends": s.depends, "done": s.done,
+                                  "estimate": None if s.done else timings.get(s.name)}
+                                 for s in steps],
+                       "critical_path": path, "total": total, "unknown": unknown},
+                      out_handle, indent=2)
+        env.logger.info("Wrote plan to %s" % output)
+    return total, path
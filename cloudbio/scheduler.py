@@ -0,0 +1,159 @@
+"""Run groups of dependent install jobs concurrently against a single target.
+
+Each job runs in its own forked process with a separate connection to the
+remote host, so independent builds proceed at the same time. Jobs start once
+everything they depend on has finished successfully and there are free
+worker slots and enough estimated memory. Output from each job is captured in
+a separate log file and failures are collected per job, skipping any jobs
+which depend on a failure. Values returned by jobs are passed back to the
+parent process.
+"""
+import collections
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from fabric.api import env
+
+JobResult = collections.namedtuple("JobResult", "status duration log_file value")
+_NO_RESULT = JobResult(None, 0, None, None)
+
+DEFAULT_JOB_MEMORY = 2.0
+
+
+class Job:
+    """A unit of work with dependencies and an estimated memory requirement.
+
+    `fn` takes no arguments and is called in a child process; its return
+    value must be picklable. `depends` names other jobs that must succeed
+    first; names not in the current set of jobs are ignored. `memory` is the
+    estimated peak memory use in gigabytes.
+    """
+    def __init__(self, name, fn, depends=None, memory=0):
+        self.name = name
+        self.fn = fn
+        self.depends = list(depends or [])
+        self.memory = memory
+
+
+def available_workers(cores, memory=None, memory_per_job=DEFAULT_JOB_MEMORY):
+    """Number of concurrent jobs for a host with the given cores and memory (Gb).
+
+    Uses the number of cores, limited by the number of jobs of `memory_per_job`
+    gigabytes that fit in memory.
+    """
+    workers = cores
+    if memory and memory_per_job:
+        workers = min(workers, int(memory // memory_per_job))
+    return max(workers, 1)
+
+
+def _job_main(job, log_file, conn):
+    """Entry point for running a job inside a child process.
+    """
+    # Force fabric to open a new connection for this process
+    from fabric.state import connections
+    connections.clear()
+    if log_file:
+        out_handle = open(log_file, "w")
+        os.dup2(out_handle.fileno(), sys.stdout.fileno())
+        os.dup2(out_handle.fileno(), sys.stderr.fileno())
+    code = 0
+    try:
+        conn.send(job.fn())
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(code)
+
+
+def _check_jobs(jobs):
+    names = set([j.name for j in jobs])
+    if len(names) != len(jobs):
+        raise ValueError("Duplicate job names in: %s" % [j.name for j in jobs])
+    # Detect cycles with a depth first walk
+    deps = dict((j.name, [d for d in j.depends if d in names]) for j in jobs)
+    done, visiting = set([]), set([])
+    def _visit(name, trail):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError("Dependency cycle between jobs: %s" % " -> ".join(trail + [name]))
+        visiting.add(name)
+        for dep in deps[name]:
+            _visit(dep, trail + [name])
+        visiting.remove(name)
+        done.add(name)
+    for j in jobs:
+        _visit(j.name, [])
+    return deps
+
+
+def run_jobs(jobs, workers, memory=None, log_dir=None, poll_interval=1.0):
+    """Run jobs concurrently, respecting dependencies, worker and memory limits.
+
+    `memory` is the total memory in gigabytes available to jobs; a job
+    requiring more than is available runs only when nothing else is running.
+    Returns a dictionary of job names to JobResult with status of 'ok',
+    'failed' or 'skipped' and the value returned by the job.
+    """
+    deps = _check_jobs(jobs)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    pending = list(jobs)
+    running = {}
+    results = {}
+    values = {}
+    while pending or running:
+        # Collect finished jobs, reading returned values before the child exits
+        for name, (proc, job, start, log_file, conn) in running.items():
+            alive = proc.is_alive()
+            if name not in values and conn.poll():
+                try:
+                    values[name] = conn.recv()
+                except EOFError:
+                    values[name] = None
+            if not alive:
+                proc.join()
+                conn.close()
+                status = "ok" if proc.exitcode == 0 else "failed"
+                results[name] = JobResult(status, time.time() - start, log_file,
+                                          values.get(name))
+                del running[name]
+                log_fn = env.logger.info if status == "ok" else env.logger.error
+                log_fn("Job %s %s in %.1fs%s" % (name, "finished" if status == "ok" else "failed",
+                                                  results[name].duration,
+                                                  "; log: %s" % log_file if log_file else ""))
+        # Skip jobs depending on failures
+        for job in list(pending):
+            if any(results.get(d, _NO_RESULT).status in ["failed", "skipped"]
+                   for d in deps[job.name]):
+                pending.remove(job)
+                results[job.name] = JobResult("skipped", 0, None, None)
+                env.logger.warn("Skipping job %s due to failed dependencies" % job.name)
+        # Start any ready jobs that fit
+        used_memory = sum(j.memory for (_, j, _, _, _) in running.values())
+        for job in list(pending):
+            if len(running) >= workers:
+                break
+            if not all(results.get(d, _NO_RESULT).status == "ok"
+                       for d in deps[job.name]):
+                continue
+            if memory and running and used_memory + job.memory > memory:
+                continue
+            log_file = os.path.join(log_dir, "%s.log" % job.name) if log_dir else None
+            recv_conn, send_conn = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=_job_main, args=(job, log_file, send_conn))
+            env.logger.info("Starting job %s" % job.name)
+            proc.start()
+            send_conn.close()
+            running[job.name] = (proc, job, time.time(), log_file, recv_conn)
+            used_memory += job.memory
+            pending.remove(job)
+        if running:
+            time.sleep(poll_interval)
+    return results
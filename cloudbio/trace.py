@@ -0,0 +1,121 @@
+"""Structured trace of install phases, steps and remote commands.
+
+When `trace_file` is set, spans covering install phases, custom programs,
+library groups, package batches, downloads, builds and every remote command
+are appended as JSON lines with start and end times, host and process. The
+file is safe to share between the processes used for concurrent installs. It
+is cleared at the start of each run, and records carry a run ID so exports
+only include the current run.
+
+At the end of a run the trace is also exported in the Chrome trace event
+format, viewable as a flame chart in chrome://tracing or Perfetto, with a
+row per host and process.
+
+Configuration, in fabricrc.txt:
+
+  - trace_file -- JSON lines file on the machine running fabric; tracing is
+    disabled if unset.
+  - trace_chrome_file -- Chrome trace output; defaults to trace_file with a
+    .chrome.json extension.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from fabric.api import env
+
+MAX_COMMAND_NAME = 80
+
+
+def enabled():
+    return bool(env.get("trace_file", None))
+
+
+def _trace_file():
+    return os.path.expanduser(env.trace_file)
+
+
+def start_run():
+    """Start a new trace, once per run, clearing records from earlier runs.
+
+    Processes forked for concurrent installs inherit the run ID and keep
+    appending to the same trace.
+    """
+    if env.get("trace_run_id"):
+        return
+    env.trace_run_id = "%s-%s" % (int(time.time()), os.getpid())
+    if enabled() and os.path.exists(_trace_file()):
+        open(_trace_file(), "w").close()
+
+
+def _write(record):
+    record["run"] = env.get("trace_run_id")
+    with open(_trace_file(), "a") as out_handle:
+        out_handle.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def span(name, category, **args):
+    """Record the time spent in a block as a named span.
+    """
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    status = "ok"
+    try:
+        yield
+    except (Exception, SystemExit, KeyboardInterrupt):
+        status = "failed"
+        raise
+    finally:
+        _write({"name": name, "cat": category, "host": env.get("host_string") or "localhost",
+                "pid": os.getpid(), "start": start, "end": time.time(), "status": status,
+                "args": args})
+
+
+def traced(run_fn, category="command"):
+    """Wrap a run function so each command is recorded as a span.
+    """
+    def _run(command, *args, **kwargs):
+        if not enabled():
+            return run_fn(command, *args, **kwargs)
+        name = command if len(command) <= MAX_COMMAND_NAME else command[:MAX_COMMAND_NAME] + "..."
+        with span(name, category, command=command, cwd=env.get("cwd", "")):
+            return run_fn(command, *args, **kwargs)
+    return _run
+
+
+def export_chrome(trace_file=None, out_file=None):
+    """Convert a JSON lines trace for the current run into Chrome trace event format.
+    """
+    trace_file = trace_file or (_trace_file() if enabled() else None)
+    if not trace_file or not os.path.exists(trace_file):
+        return None
+    out_file = out_file or env.get("trace_chrome_file", None) or \
+        "%s.chrome.json" % os.path.splitext(trace_file)[0]
+    hosts = {}
+    events = []
+    with open(trace_file) as in_handle:
+        for line in in_handle:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if env.get("trace_run_id") and rec.get("run") != env.trace_run_id:
+                continue
+            if rec["host"] not in hosts:
+                hosts[rec["host"]] = len(hosts) + 1
+                events.append({"name": "process_name", "ph": "M", "pid": hosts[rec["host"]],
+                               "args": {"name": rec["host"]}})
+            args = dict(rec.get("args", {}))
+            args["status"] = rec.get("status")
+            events.append({"name": rec["name"], "cat": rec["cat"], "ph": "X",
+                           "ts": int(rec["start"] * 1e6),
+                           "dur": int((rec["end"] - rec["start"]) * 1e6),
+                           "pid": hosts[rec["host"]], "tid": rec["pid"], "args": args})
+    with open(out_file, "w") as out_handle:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out_handle)
+    env.logger.info("Wrote trace of %s events to %s" % (len(events), out_file))
+    return out_file
@@ -47,7 +47,21 @@ class ColorFormatter(logging.Formatter):
         self._fmt = format_orig
         return result
 
-def _setup_logging(env):
+class HostPrefixFilter(logging.Filter):
+    """ Prefix log messages with the current host, for runs against many hosts
+        at once.
+    """
+    def __init__(self, env):
+        logging.Filter.__init__(self)
+        self.env = env
+
+    def filter(self, record):
+        host = self.env.get("host_string")
+        if host:
+            record.msg = "[%s] %s" % (host, record.msg)
+        return True
+
+def _setup_logging(env, host_prefix=False):
     env.logger = logging.getLogger("cloudbiolinux")
     env.logger.setLevel(logging.DEBUG)
 
@@ -55,6 +69,8 @@ def _setup_logging(env):
     ch.setLevel(logging.DEBUG)
     # Use custom formatter
     ch.setFormatter(ColorFormatter())
+    if host_prefix:
+        ch.addFilter(HostPrefixFilter(env))
     env.logger.addHandler(ch)
 
 def _update_biolinux_log(env, target, flavor):
@@ -0,0 +1,160 @@
+"""Install python libraries from a wheelhouse built once for all targets.
+
+Installing each package from python-libs.yaml with pip resolves and compiles
+it again on every host. With a wheelhouse, wheels for the full requirement
+set are built a single time and stored as a tarball on the machine running
+fabric. Targets receive the tarball and install everything in one
+`pip install --no-index --find-links` transaction.
+
+The wheelhouse is built on a cache miss by the first target that needs it,
+by the machine running fabric or by a separate build node. Concurrent fabric
+processes for other hosts wait for the build instead of repeating it.
+Wheelhouses are keyed by the requirement set, the python version, and the
+distribution and architecture of the target. URL and version control
+requirements are left to the regular per-package install, as is everything
+when building or installing from the wheelhouse fails.
+
+Configuration, in fabricrc.txt:
+
+  - python_wheelhouse -- True to build on the first target, `controller` to
+    build on the machine running fabric or a host string for a build node.
+  - python_wheelhouse_dir -- Directory to keep wheelhouses in.
+  - python_wheelhouse_pip -- pip command used on the controller or build node.
+"""
+import os
+import re
+import tempfile
+
+from fabric.api import env, settings, hide, local, run, get
+
+from cloudbio import cache, hostfacts, trace
+
+
+def _setting():
+    setting = env.get("python_wheelhouse", None)
+    if str(setting).lower() in ["", "none", "false", "no"]:
+        return None
+    return setting
+
+
+def wheelhouse_cache():
+    return cache.FileCache(env.get("python_wheelhouse_dir", "~/.cloudbiolinux/wheelhouse"),
+                           name="wheelhouse")
+
+
+def _is_plain(item):
+    return not ("/" in item or ":" in item)
+
+
+def _quote(items):
+    return " ".join("'%s'" % x for x in items)
+
+
+def _python_version(pip_cmd):
+    def _retrieve():
+        with settings(hide('everything'), warn_only=True):
+            out = env.safe_run_output("%s --version" % pip_cmd)
+        match = re.search(r"\(python ([\d.]+)\)", out)
+        return match.group(1) if match else ""
+    return hostfacts.get_fact("pip_python_version", _retrieve)
+
+
+def _build_local(requirements, tarball):
+    build_dir = tempfile.mkdtemp(dir=os.path.dirname(tarball))
+    try:
+        with settings(warn_only=True):
+            result = local("%s wheel --wheel-dir %s %s"
+                           % (env.get("python_wheelhouse_pip", "pip"), build_dir,
+                              _quote(requirements)))
+        if result.succeeded:
+            local("tar -C %s -czf %s ." % (build_dir, tarball))
+        return result.succeeded
+    finally:
+        local("rm -rf %s" % build_dir)
+
+
+def _build_remote(requirements, tarball, pip_cmd, run_fn, get_fn):
+    name = os.path.basename(tarball).replace(".tar.gz", "")
+    build_dir = os.path.join(hostfacts.tmp_dir() or "/tmp", name)
+    run_fn("rm -rf %s && mkdir -p %s" % (build_dir, build_dir))
+    try:
+        with settings(warn_only=True):
+            result = run_fn("%s wheel --wheel-dir %s %s" % (pip_cmd, build_dir, _quote(requirements)))
+        if result.succeeded:
+            run_fn("tar -C %s -czf %s.tar.gz ." % (build_dir, build_dir))
+            get_fn("%s.tar.gz" % build_dir, tarball)
+        return result.succeeded
+    finally:
+        run_fn("rm -rf %s %s.tar.gz" % (build_dir, build_dir))
+
+
+def _build(requirements, key, pip_cmd):
+    """Build wheels for all requirements, adding a tarball of them to the cache.
+    """
+    wheels = wheelhouse_cache()
+    setting = _setting()
+    fd, tarball = tempfile.mkstemp(suffix=".tar.gz", dir=wheels.cache_dir)
+    os.close(fd)
+    env.logger.info("Building python wheelhouse for %s packages" % len(requirements))
+    try:
+        with trace.span("python wheelhouse", "build", packages=len(requirements)):
+            if setting == "controller":
+                ok = _build_local(requirements, tarball)
+            elif str(setting).lower() in ["true", "yes"]:
+                ok = _build_remote(requirements, tarball, pip_cmd, env.safe_run, env.safe_get)
+            else:
+                with settings(host_string=setting):
+                    ok = _build_remote(requirements, tarball,
+                                       env.get("python_wheelhouse_pip", "pip"), run, get)
+        if ok:
+            return wheels.add(key, tarball, "wheelhouse-%s.tar.gz" % key[:12],
+                              " ".join(requirements))
+        return None
+    finally:
+        if os.path.exists(tarball):
+            os.remove(tarball)
+
+
+def _wheelhouse(requirements, pip_cmd):
+    """Retrieve the local wheelhouse tarball for a requirement set, building on a miss.
+    """
+    wheels = wheelhouse_cache()
+    key = wheels.key("wheelhouse", _python_version(pip_cmd), env.get("distribution", ""),
+                     env.get("dist_name", ""), hostfacts.machine(), *sorted(requirements))
+    cached = wheels.get(key)
+    if cached:
+        return cached
+    with cache.locked(os.path.join(wheels.cache_dir, "%s.lock" % key)):
+        # another process may have finished the build while we waited
+        return wheels.get(key) or _build(requirements, key, pip_cmd)
+
+
+def install(pip_cmd, run_fn, requirements, to_install):
+    """Install packages from a wheelhouse built for the full requirement set.
+
+    Returns the packages from `to_install` which still need a regular pip
+    install: all of them if the wheelhouse is disabled or fails.
+    """
+    if not _setting():
+        return to_install
+    plain = [x for x in to_install if _is_plain(x)]
+    remaining = [x for x in to_install if not _is_plain(x)]
+    if not plain:
+        return remaining
+    tarball = _wheelhouse([x for x in requirements if _is_plain(x)], pip_cmd)
+    if not tarball:
+        env.logger.warn("Could not build python wheelhouse; installing packages individually")
+        return to_install
+    remote_dir = os.path.join(hostfacts.tmp_dir() or "/tmp",
+                              os.path.basename(tarball).replace(".tar.gz", ""))
+    env.safe_run("rm -rf %s && mkdir -p %s" % (remote_dir, remote_dir))
+    env.safe_put(tarball, "%s.tar.gz" % remote_dir)
+    env.safe_run("tar -C %s -xzf %s.tar.gz" % (remote_dir, remote_dir))
+    with settings(warn_only=True):
+        result = run_fn("%s install --upgrade --no-index --find-links %s %s"
+                        % (pip_cmd, remote_dir, _quote(plain)))
+    env.safe_run("rm -rf %s %s.tar.gz" % (remote_dir, remote_dir))
+    if result.failed:
+        env.logger.warn("Installing from python wheelhouse failed; installing packages individually")
+        return to_install
+    return remaining
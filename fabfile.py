@@ -15,8 +15,12 @@ Requires:
     Fabric http://docs.fabfile.org
     PyYAML http://pyyaml.org/wiki/PyYAMLDocumentation
 """
+import json
+import multiprocessing
 import os
+import re
 import sys
+import time
 from datetime import datetime
 
 from fabric.api import *
@@ -29,15 +33,17 @@ for to_remove in [p for p in sys.path if p.find("cloudbiolinux-") > 0]:
 sys.path.append(os.path.dirname(__file__))
 import cloudbio
 
-from cloudbio import libraries
+from cloudbio import cache, hostfacts, inventory, ledger, libraries, planner, scheduler, trace, wheelhouse
 from cloudbio.utils import _setup_logging, _configure_fabric_environment
 from cloudbio.cloudman import _cleanup_ec2
 from cloudbio.cloudbiolinux import _cleanup_space
 from cloudbio.custom import shared
-from cloudbio.package.shared import _yaml_to_packages
+from cloudbio.package.shared import _yaml_to_packages, _load_yaml
 from cloudbio.package import (_configure_and_install_native_packages,
-                              _connect_native_packages)
+                              _connect_native_packages, _native_package_list,
+                              _native_packages_version)
 from cloudbio.package.nix import _setup_nix_sources, _nix_packages
+from cloudbio.package import proxy
 from cloudbio.flavor.config import get_config_file
 from cloudbio.config_management.puppet import _puppet_provision
 from cloudbio.config_management.chef import _chef_provision, chef, _configure_chef
@@ -70,9 +76,99 @@ def install_biolinux(target=None, flavor=None):
                                   ignore_distcheck=(target is not None
                                                     and target in ["libraries", "custom"]))
     env.logger.debug("Target is '%s'" % target)
+    trace.start_run()
     _perform_install(target, flavor)
+    cache.log_stats()
+    shared.log_ccache_stats()
+    trace.export_chrome()
     _print_time_stats("Config", "end", time_start)
 
+@runs_once
+def install_biolinux_hosts(target=None, flavor=None, workers=10, report="cbl_host_report.json"):
+    """Install BioLinux on many hosts at once, for provisioning clusters.
+
+    Usage:
+
+        fab -H host1,host2,host3 -i key install_biolinux_hosts:flavor=my_flavor,workers=10
+
+    Runs the `install_biolinux` steps (see there for `target` and `flavor`)
+    against all hosts with a pool of at most `workers` concurrent hosts. Log
+    lines are prefixed with the host. A failure on one host does not stop
+    installs on the others; per-host timing, failures and cache hit rates are
+    summarized at the end and written as JSON to `report`.
+    """
+    _setup_logging(env, host_prefix=True)
+    _check_fabric_version()
+    hosts = list(env.hosts)
+    env.logger.info("Installing on %s hosts with %s workers" % (len(hosts), workers))
+    trace.start_run()
+    proxy.prepare()
+    install_fn = parallel(pool_size=int(workers))(_install_host)
+    results = execute(install_fn, target, flavor, hosts=hosts)
+    failed = _report_hosts(results, report)
+    trace.export_chrome()
+    if failed:
+        abort("Install failed on hosts: %s" % ", ".join(failed))
+
+def _install_host(target=None, flavor=None):
+    """Install on the current host, capturing failures instead of aborting.
+    """
+    start = time.time()
+    result = {"status": "ok", "error": None}
+    try:
+        _configure_fabric_environment(env, flavor,
+                                      ignore_distcheck=(target is not None
+                                                        and target in ["libraries", "custom"]))
+        _perform_install(target, flavor)
+    except (Exception, SystemExit), e:
+        env.logger.exception("Install failed on %s" % env.host_string)
+        result = {"status": "failed", "error": str(e) or e.__class__.__name__}
+    result["duration"] = time.time() - start
+    result["cache_stats"] = cache.take_stats()
+    try:
+        result["ccache_stats"] = shared.ccache_run_stats()
+    except (Exception, SystemExit):
+        result["ccache_stats"] = None
+    return result
+
+def _host_cache_summary(result):
+    """Describe download, artifact and compiler cache use on a host.
+    """
+    parts = []
+    for cache_dir, stats in sorted((result.get("cache_stats") or {}).items()):
+        if stats["hits"] + stats["misses"] > 0:
+            parts.append("%s cache %s hits, %s misses" % (os.path.basename(cache_dir),
+                                                          stats["hits"], stats["misses"]))
+    ccache = result.get("ccache_stats")
+    if ccache and ccache["hits"] + ccache["misses"] > 0:
+        parts.append("compiler cache %s hits, %s misses" % (ccache["hits"], ccache["misses"]))
+    return "; ".join(parts)
+
+def _report_hosts(results, report_file=None):
+    """Summarize per-host install timing and failures.
+    """
+    failed = []
+    for host, result in sorted(results.items()):
+        if not isinstance(result, dict):
+            result = {"status": "failed", "error": str(result), "duration": None}
+            results[host] = result
+        duration = ("%.1f minutes" % (result["duration"] / 60.0)
+                    if result["duration"] is not None else "unknown time")
+        summary = _host_cache_summary(result)
+        summary = " (%s)" % summary if summary else ""
+        if result["status"] == "ok":
+            env.logger.info("%s: finished in %s%s" % (host, duration, summary))
+        else:
+            failed.append(host)
+            env.logger.error("%s: failed after %s: %s%s" % (host, duration, result["error"],
+                                                            summary))
+    env.logger.info("Installed %s of %s hosts" % (len(results) - len(failed), len(results)))
+    if report_file:
+        with open(report_file, "w") as out_handle:
+            json.dump(results, out_handle, indent=2, sort_keys=True)
+        env.logger.info("Host report written to %s" % report_file)
+    return failed
+
 def _perform_install(target=None, flavor=None):
     """
     Once CBL/fabric environment is setup, this method actually
@@ -83,29 +179,96 @@ def _perform_install(target=None, flavor=None):
     """
     pkg_install, lib_install, custom_ignore, custom_add = _read_main_config()
     if target is None or target == "packages":
-        # can only install native packages if we have sudo access.
+        with trace.span("packages", "phase"):
+            # can only install native packages if we have sudo access.
+            if env.use_sudo:
+                _configure_and_install_native_packages(env, pkg_install)
+            else:
+                _connect_native_packages(env, pkg_install, lib_install)
+            if env.nixpkgs:  # ./doc/nixpkgs.md
+                with planner.timed("nix"):
+                    _setup_nix_sources()
+                    _nix_packages(pkg_install)
+    if target is None or target == "custom":
+        with trace.span("custom", "phase"):
+            _custom_installs(pkg_install, custom_ignore, custom_add)
+    if target is None or target == "chef_recipes":
+        with trace.span("chef_recipes", "phase"), planner.timed("chef_recipes"):
+            _provision_chef_recipes(pkg_install, custom_ignore)
+    if target is None or target == "puppet_classes":
+        with trace.span("puppet_classes", "phase"), planner.timed("puppet_classes"):
+            _provision_puppet_classes(pkg_install, custom_ignore)
+    if target is None or target == "libraries":
+        with trace.span("libraries", "phase"):
+            _do_library_installs(lib_install)
+    if target is None or target == "post_install":
+        with trace.span("post_install", "phase"), planner.timed("post_install"):
+            env.edition.post_install(pkg_install=pkg_install)
+            env.flavor.post_install()
+    if target is None or target == "cleanup":
+        with trace.span("cleanup", "phase"), planner.timed("cleanup"):
+            _cleanup_space(env)
+            if "is_ec2_image" in env and env.is_ec2_image.upper() in ["TRUE", "YES"]:
+                _cleanup_ec2(env)
+
+def plan(target=None, flavor=None, output=None):
+    """Show the steps an install would run, with estimated times, without running them.
+
+    Usage:
+
+        fab -H host plan:flavor=my_flavor,output=plan.json
+
+    Resolves the configured package, custom program and library lists for
+    `target` and `flavor` (see `install_biolinux`) into ordered steps. Each
+    step is annotated with the median of its durations from previous runs, and
+    steps already completed according to the install ledger are marked as
+    skipped. Finishes with the critical path and the total estimated time,
+    optionally writing the full plan as JSON to `output`.
+    """
+    _setup_logging(env)
+    _configure_fabric_environment(env, flavor,
+                                  ignore_distcheck=(target is not None
+                                                    and target in ["libraries", "custom"]))
+    planner.report(_plan_steps(target), {"custom": _custom_install_workers()}, output)
+
+def _plan_steps(target=None):
+    """Resolve configuration into the install steps run for a target.
+    """
+    pkg_install, lib_install, custom_ignore, custom_add = _read_main_config()
+    steps = []
+    if target is None or target == "packages":
         if env.use_sudo:
-            _configure_and_install_native_packages(env, pkg_install)
-        else:
-            _connect_native_packages(env, pkg_install, lib_install)
-        if env.nixpkgs:  # ./doc/nixpkgs.md
-            _setup_nix_sources()
-            _nix_packages(pkg_install)
+            steps.append(planner.Step("packages", "packages", _native_package_list(env, pkg_install),
+                                      done=ledger.is_done("packages",
+                                                          _native_packages_version(pkg_install))))
+        if env.nixpkgs:
+            steps.append(planner.Step("nix", "packages"))
     if target is None or target == "custom":
-        _custom_installs(pkg_install, custom_ignore, custom_add)
+        packages, pkg_to_group = _custom_packages(pkg_install, custom_ignore, custom_add)
+        depends = _custom_depends()
+        for p in packages:
+            steps.append(planner.Step("custom:%s" % p, "custom", [p],
+                                      ["custom:%s" % d for d in depends.get(p, [])],
+                                      ledger.is_done("custom:%s" % p,
+                                                     _custom_install_version(p, pkg_to_group))))
     if target is None or target == "chef_recipes":
-        _provision_chef_recipes(pkg_install, custom_ignore)
+        steps.append(planner.Step("chef_recipes", "chef_recipes",
+                                  _provision_items("chef_recipes", pkg_install, custom_ignore)))
     if target is None or target == "puppet_classes":
-        _provision_puppet_classes(pkg_install, custom_ignore)
+        steps.append(planner.Step("puppet_classes", "puppet_classes",
+                                  _provision_items("puppet_classes", pkg_install, custom_ignore)))
     if target is None or target == "libraries":
-        _do_library_installs(lib_install)
+        for iname in lib_install:
+            config = _library_config(iname)
+            items = [x for vals in config.values() if isinstance(vals, list) for x in vals]
+            steps.append(planner.Step("library:%s" % iname, "libraries", items,
+                                      done=ledger.is_done("library:%s" % iname,
+                                                          _library_version(iname, config))))
     if target is None or target == "post_install":
-        env.edition.post_install(pkg_install=pkg_install)
-        env.flavor.post_install()
+        steps.append(planner.Step("post_install", "post_install"))
     if target is None or target == "cleanup":
-        _cleanup_space(env)
-        if "is_ec2_image" in env and env.is_ec2_image.upper() in ["TRUE", "YES"]:
-            _cleanup_ec2(env)
+        steps.append(planner.Step("cleanup", "cleanup"))
+    return steps
 
 def _print_time_stats(action, event, prev_time=None):
     """ A convenience method for displaying time event during configuration.
@@ -140,6 +303,27 @@ def _check_fabric_version():
 def _custom_installs(to_install, ignore=None, add=None):
     if not env.safe_exists(env.local_install) and env.local_install:
         env.safe_run("mkdir -p %s" % env.local_install)
+    packages, pkg_to_group = _custom_packages(to_install, ignore, add)
+    versions = dict((p, _custom_install_version(p, pkg_to_group)) for p in packages)
+    done = [p for p in packages if ledger.is_done("custom:%s" % p, versions[p])]
+    if done:
+        env.logger.info("Skipping custom programs completed previously (install ledger): %s"
+                        % ", ".join(done))
+    packages = [p for p in packages if p not in done]
+    workers = _custom_install_workers()
+    # Record compiler cache statistics before any builds start
+    shared._ccache_bin()
+    if workers > 1:
+        _parallel_custom_installs(packages, pkg_to_group, workers, versions)
+    else:
+        for p in packages:
+            with planner.timed("custom:%s" % p):
+                install_custom(p, True, pkg_to_group)
+            ledger.record("custom:%s" % p, versions[p])
+
+def _custom_packages(to_install, ignore=None, add=None):
+    """Retrieve custom programs to install, with a mapping to their groups.
+    """
     pkg_config = get_config_file(env, "custom.yaml").base
     packages, pkg_to_group = _yaml_to_packages(pkg_config, to_install)
     packages = [p for p in packages if ignore is None or p not in ignore]
@@ -148,8 +332,101 @@ def _custom_installs(to_install, ignore=None, add=None):
             for v in vals:
                 pkg_to_group[v] = key
                 packages.append(v)
-    for p in env.flavor.rewrite_config_items("custom", packages):
-        install_custom(p, True, pkg_to_group)
+    return list(env.flavor.rewrite_config_items("custom", packages)), pkg_to_group
+
+def _custom_depends():
+    """Dependencies between custom programs, from custom_depends.yaml.
+    """
+    depends_file = get_config_file(env, "custom_depends.yaml").base
+    if depends_file:
+        return _load_yaml(depends_file) or {}
+    return {}
+
+def _custom_install_version(p, pkg_to_group):
+    """Ledger version for a custom program, from the code of its install function.
+
+    Versions of custom programs are set in the install functions, so are
+    covered by the code fingerprint. Returns None, so the program is neither
+    skipped nor recorded, if no install function resolves.
+    """
+    try:
+        fn = _custom_install_function(env, p.lower(), pkg_to_group)
+    except ImportError:
+        return None
+    return ledger.version_hash(fn)
+
+def _custom_install_workers():
+    """Number of custom programs to build at once, from `custom_install_workers`.
+    """
+    setting = str(env.get("custom_install_workers", "1"))
+    if setting.lower() == "auto":
+        return scheduler.available_workers(hostfacts.cores(), hostfacts.memory_gb())
+    return max(int(setting), 1)
+
+# Package manager commands, which can not run at the same time on a target
+PACKAGE_MANAGER_RE = re.compile(r"\b(apt-get|aptitude|dpkg|yum|rpm)\b")
+
+def _serialize_package_commands(lock):
+    """Run package manager commands from concurrent jobs one at a time.
+    """
+    def _wrap(run_fn):
+        def _run(command, *args, **kwargs):
+            if PACKAGE_MANAGER_RE.search(command):
+                with lock:
+                    return run_fn(command, *args, **kwargs)
+            return run_fn(command, *args, **kwargs)
+        return _run
+    env.safe_run = _wrap(env.safe_run)
+    env.safe_sudo = _wrap(env.safe_sudo)
+
+def _parallel_custom_installs(packages, pkg_to_group, workers, versions=None):
+    """Build custom programs concurrently, ordered by declared dependencies.
+
+    Each build gets a separate working directory on the target and a separate
+    log file locally; failed builds do not stop unrelated builds. Package
+    manager commands from different builds run one at a time.
+    """
+    depends = _custom_depends()
+    base_work_dir = shared._work_dir()
+    log_dir = os.path.join(env.get("custom_install_log_dir", "cbl_logs"),
+                           env.host_string or "localhost")
+    package_lock = multiprocessing.Lock()
+    def _install_job(p):
+        def _run():
+            env.work_dir = os.path.join(base_work_dir, p)
+            env.concurrent_builds = True
+            env.build_workers = workers
+            _serialize_package_commands(package_lock)
+            # only report cache use by this job back to the parent
+            cache.take_stats()
+            with planner.timed("custom:%s" % p):
+                install_custom(p, True, pkg_to_group)
+            ledger.record("custom:%s" % p, (versions or {}).get(p))
+            return cache.take_stats()
+        return _run
+    jobs = [scheduler.Job(p, _install_job(p), depends.get(p), scheduler.DEFAULT_JOB_MEMORY)
+            for p in packages]
+    env.logger.info("Installing %s custom programs with %s workers; logs in %s"
+                    % (len(jobs), workers, log_dir))
+    results = scheduler.run_jobs(jobs, workers, hostfacts.memory_gb(), log_dir)
+    # builds ran in child processes, so facts cached here may be out of date
+    hostfacts.invalidate(hostfacts.EXECUTABLE_FACTS + hostfacts.PYTHON_FACTS)
+    for r in results.itervalues():
+        cache.merge_stats(r.value)
+    problems = sorted(["%s (%s)" % (p, r.status) for p, r in results.iteritems()
+                       if r.status != "ok"])
+    if problems:
+        raise ValueError("Custom installs did not complete: %s. See logs in %s"
+                         % (", ".join(problems), log_dir))
+
+
+def _provision_items(config_name, to_install, ignore=None):
+    """Retrieve chef recipes or puppet classes to provision from configuration.
+    """
+    pkg_config = get_config_file(env, "%s.yaml" % config_name).base
+    packages, _ = _yaml_to_packages(pkg_config, to_install)
+    packages = [p for p in packages if ignore is None or p not in ignore]
+    return [item for item in env.flavor.rewrite_config_items(config_name, packages)]
 
 
 def _provision_chef_recipes(to_install, ignore=None):
@@ -157,10 +434,7 @@ def _provision_chef_recipes(to_install, ignore=None):
     Much like _custom_installs, read config file, determine what to install,
     and install it.
     """
-    pkg_config = get_config_file(env, "chef_recipes.yaml").base
-    packages, _ = _yaml_to_packages(pkg_config, to_install)
-    packages = [p for p in packages if ignore is None or p not in ignore]
-    recipes = [recipe for recipe in env.flavor.rewrite_config_items("chef_recipes", packages)]
+    recipes = _provision_items("chef_recipes", to_install, ignore)
     if recipes:  # Don't bother running chef if nothing to configure
         install_chef_recipe(recipes, True)
 
@@ -170,10 +444,7 @@ def _provision_puppet_classes(to_install, ignore=None):
     Much like _custom_installs, read config file, determine what to install,
     and install it.
     """
-    pkg_config = get_config_file(env, "puppet_classes.yaml").base
-    packages, _ = _yaml_to_packages(pkg_config, to_install)
-    packages = [p for p in packages if ignore is None or p not in ignore]
-    classes = [recipe for recipe in env.flavor.rewrite_config_items("puppet_classes", packages)]
+    classes = _provision_items("puppet_classes", to_install, ignore)
     if classes:  # Don't bother running chef if nothing to configure
         install_puppet_class(classes, True)
 
@@ -253,7 +524,8 @@ def install_custom(p, automated=False, pkg_to_group=None, flavor=None):
         packages, pkg_to_group = _yaml_to_packages(pkg_config, None)
     time_start = _print_time_stats("Custom install for '{0}'".format(p), "start")
     fn = _custom_install_function(env, p, pkg_to_group)
-    fn(env)
+    with trace.span("custom:%s" % p, "custom"):
+        fn(env)
     ## TODO: Replace the previous 4 lines with the following one, barring
     ## objections. Slightly different behavior because pkg_to_group will be
     ## loaded regardless of automated if it is None, but IMO this shouldn't
@@ -306,8 +578,7 @@ def _read_main_config():
     Reads 'main.yaml' and returns packages and libraries
     """
     yaml_file = get_config_file(env, "main.yaml").base
-    with open(yaml_file) as in_handle:
-        full_data = yaml.load(in_handle)
+    full_data = _load_yaml(yaml_file)
     packages = full_data.get('packages', [])
     libraries = full_data.get('libraries', [])
     custom_ignore = full_data.get('custom_ignore', [])
@@ -321,55 +592,55 @@ def _read_main_config():
 
 # ### Library specific installation code
 
+def _conda_library_installer(pnames):
+    """Install conda packages with a single solve, optionally from a lock file.
+
+    With a `conda_lock_file` on the machine running fabric, targets install
+    the exact packages it lists; when missing, the lock file is written from
+    the first target installed. `conda_pkgs_dir` adds a package cache
+    directory, such as a pre-seeded shared filesystem, to conda's pkgs_dirs.
+    """
+    conda_cmd = shared._conda_cmd(env)
+    pkgs_dir = env.get("conda_pkgs_dir", None)
+    if pkgs_dir:
+        with settings(hide('everything'), warn_only=True):
+            current = env.safe_run_output("%s config --get pkgs_dirs" % conda_cmd)
+        if pkgs_dir not in current:
+            env.safe_run("%s config --add pkgs_dirs %s" % (conda_cmd, pkgs_dir))
+    lock_file = env.get("conda_lock_file", None)
+    lock_file = os.path.abspath(os.path.expanduser(lock_file)) if lock_file else None
+    with shared._make_tmp_dir() as work_dir:
+        remote_lock = os.path.join(work_dir, "cbl_conda_lock.txt")
+        if lock_file and os.path.exists(lock_file):
+            env.safe_put(lock_file, remote_lock)
+            env.safe_run("%s install --yes --file %s" % (conda_cmd, remote_lock))
+            return
+        pnames = inventory.to_install(pnames, inventory.conda_packages(conda_cmd))
+        if pnames:
+            env.safe_run("%s install --yes %s" % (conda_cmd, " ".join(pnames)))
+        if lock_file:
+            env.safe_run("%s list --explicit > %s" % (conda_cmd, remote_lock))
+            env.safe_get(remote_lock, lock_file)
+            env.logger.info("Wrote conda lock file %s" % lock_file)
+
 def _python_library_installer(config):
     """Install python specific libraries using easy_install.
     Handles using isolated anaconda environments.
     """
     if shared._is_anaconda(env):
-        for pname in env.flavor.rewrite_config_items("python", config.get("conda", [])):
-            env.safe_run("{0} install --yes {1}".format(shared._conda_cmd(env), pname))
+        _conda_library_installer(list(env.flavor.rewrite_config_items("python", config.get("conda", []))))
         cmd = env.safe_run
     else:
         version_ext = "-%s" % env.python_version_ext if env.python_version_ext else ""
         env.safe_sudo("easy_install%s -U pip" % version_ext)
         cmd = env.safe_sudo
-    for pname in env.flavor.rewrite_config_items("python", config['pypi']):
-        cmd("{0} install --upgrade {1}".format(shared._pip_cmd(env), pname))
-
-def _ruby_library_installer(config):
-    """Install ruby specific gems.
-    """
-    gem_ext = getattr(env, "ruby_version_ext", "")
-    def _cur_gems():
-        with settings(
-                hide('warnings', 'running', 'stdout', 'stderr')):
-            gem_info = env.safe_run_output("gem%s list --no-versions" % gem_ext)
-        return [l.rstrip("\r") for l in gem_info.split("\n") if l.rstrip("\r")]
-    installed = _cur_gems()
-    for gem in env.flavor.rewrite_config_items("ruby", config['gems']):
-        # update current gems only to check for new installs
-        if gem not in installed:
-            installed = _cur_gems()
-        if gem in installed:
-            env.safe_sudo("gem%s update %s" % (gem_ext, gem))
-        else:
-            env.safe_sudo("gem%s install %s" % (gem_ext, gem))
-
-def _perl_library_installer(config):
-    """Install perl libraries from CPAN with cpanminus.
-    """
-    with shared._make_tmp_dir() as tmp_dir:
-        with cd(tmp_dir):
-            env.safe_run("wget --no-check-certificate -O cpanm "
-                         "https://raw.github.com/miyagawa/cpanminus/master/cpanm")
-            env.safe_run("chmod a+rwx cpanm")
-            env.safe_sudo("mv cpanm %s/bin" % env.system_install)
-    sudo_str = "--sudo" if env.use_sudo else ""
-    for lib in env.flavor.rewrite_config_items("perl", config['cpan']):
-        # Need to hack stdin because of some problem with cpanminus script that
-        # causes fabric to hang
-        # http://agiletesting.blogspot.com/2010/03/getting-past-hung-remote-processes-in.html
-        env.safe_run("cpanm %s --skip-installed --notest %s < /dev/null" % (sudo_str, lib))
+    pip_cmd = shared._pip_cmd(env)
+    requirements = list(env.flavor.rewrite_config_items("python", config['pypi']))
+    pnames = inventory.to_install(requirements,
+                                  inventory.python_packages(pip_cmd), inventory.python_outdated(pip_cmd),
+                                  inventory.normalize_python)
+    for pname in wheelhouse.install(pip_cmd, cmd, requirements, pnames):
+        cmd("{0} install --upgrade {1}".format(pip_cmd, pname))
 
 def _haskell_library_installer(config):
     """Install haskell libraries using cabal.
@@ -382,8 +653,8 @@ def _haskell_library_installer(config):
 lib_installers = {
     "r-libs" : libraries.r_library_installer,
     "python-libs" : _python_library_installer,
-    "ruby-libs" : _ruby_library_installer,
-    "perl-libs" : _perl_library_installer,
+    "ruby-libs" : libraries.ruby_library_installer,
+    "perl-libs" : libraries.perl_library_installer,
     "haskell-libs": _haskell_library_installer,
     }
 
@@ -397,7 +668,28 @@ def install_libraries(language):
 
 def _do_library_installs(to_install):
     for iname in to_install:
-        yaml_file = get_config_file(env, "%s.yaml" % iname).base
-        with open(yaml_file) as in_handle:
-            config = yaml.load(in_handle)
-        lib_installers[iname](config)
+        config = _library_config(iname)
+        version = _library_version(iname, config)
+        if ledger.is_done("library:%s" % iname, version):
+            env.logger.info("Skipping %s; completed previously (install ledger)" % iname)
+            continue
+        with trace.span("library:%s" % iname, "library"), planner.timed("library:%s" % iname):
+            lib_installers[iname](config)
+        ledger.record("library:%s" % iname, version)
+
+def _library_config(iname):
+    return _load_yaml(get_config_file(env, "%s.yaml" % iname).base)
+
+# Library configuration lists rewritten by flavors before installing
+LIBRARY_REWRITES = {"python-libs": [("python", "pypi"), ("python", "conda")],
+                    "ruby-libs": [("ruby", "gems")],
+                    "perl-libs": [("perl", "cpan")]}
+
+def _library_version(iname, config):
+    """Ledger version for a library group, from its installer and the items it installs.
+    """
+    resolved = dict(config)
+    for name, key in LIBRARY_REWRITES.get(iname, []):
+        if key in resolved:
+            resolved[key] = list(env.flavor.rewrite_config_items(name, resolved[key]))
+    return ledger.version_hash(lib_installers[iname], resolved)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Minimal caching HTTP proxy for distribution packages.
+
+A stand-in for apt-cacher-ng when testing deployments, or for running a
+package cache on the machine running fabric. Targets point apt or yum at it
+as an HTTP proxy; package files (.deb, .rpm and similar) are cached on disk
+by URL and served from the cache on later requests, while repository index
+files are always passed through so targets see current metadata.
+
+Only plain HTTP is proxied; configure HTTPS repositories to connect directly.
+
+Usage:
+    python utils/cbl_package_proxy.py [--port 3142] [--cache-dir ~/.cloudbiolinux/packages]
+"""
+import hashlib
+import optparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen, Request, HTTPError, URLError
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+
+CACHE_EXTS = (".deb", ".udeb", ".rpm", ".drpm", ".ddeb")
+CHUNK_SIZE = 1024 * 1024
+UPSTREAM_TIMEOUT = 60
+
+
+def main(port, cache_dir):
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    ProxyHandler.cache_dir = cache_dir
+    server = ThreadedHTTPServer(("", port), ProxyHandler)
+    sys.stderr.write("Caching packages in %s; proxy listening on port %s\n" % (cache_dir, port))
+    server.serve_forever()
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    cache_dir = None
+
+    def do_GET(self):
+        url = self.path
+        if not url.startswith("http://"):
+            self.send_error(400, "Only absolute http:// URLs are proxied")
+            return
+        if url.split("?")[0].endswith(CACHE_EXTS):
+            self._send_cached(url)
+        else:
+            self._send_upstream(url)
+
+    def _cache_file(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _open_upstream(self, url):
+        """Open an upstream URL, sending an error response and returning None on failure.
+        """
+        try:
+            return urlopen(Request(url), timeout=UPSTREAM_TIMEOUT)
+        except HTTPError as e:
+            self.send_error(e.code, str(e))
+        except (URLError, socket.timeout, socket.error) as e:
+            self.send_error(502, "Upstream fetch failed: %s" % e)
+        return None
+
+    def _send_cached(self, url):
+        cache_file = self._cache_file(url)
+        if not os.path.exists(cache_file):
+            response = self._open_upstream(url)
+            if response is None:
+                return
+            if not os.path.exists(os.path.dirname(cache_file)):
+                try:
+                    os.makedirs(os.path.dirname(cache_file))
+                except OSError:
+                    pass
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+            try:
+                with os.fdopen(fd, "wb") as out_handle:
+                    shutil.copyfileobj(response, out_handle, CHUNK_SIZE)
+            except (socket.timeout, socket.error) as e:
+                os.remove(tmp_file)
+                self.send_error(502, "Upstream fetch failed: %s" % e)
+                return
+            os.rename(tmp_file, cache_file)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(cache_file)))
+        self.end_headers()
+        with open(cache_file, "rb") as in_handle:
+            shutil.copyfileobj(in_handle, self.wfile, CHUNK_SIZE)
+
+    def _send_upstream(self, url):
+        response = self._open_upstream(url)
+        if response is None:
+            return
+        self.send_response(response.getcode())
+        for header in ["Content-Type", "Content-Length", "Last-Modified"]:
+            value = response.info().get(header)
+            if value:
+                self.send_header(header, value)
+        self.end_headers()
+        shutil.copyfileobj(response, self.wfile, CHUNK_SIZE)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", dest="port", type="int", default=3142)
+    parser.add_option("-c", "--cache-dir", dest="cache_dir",
+                      default="~/.cloudbiolinux/packages")
+    (options, args) = parser.parse_args()
+    main(options.port, options.cache_dir)